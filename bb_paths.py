@@ -2,10 +2,16 @@
 import argparse
 import copy
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import netaddr
 
-from lib import general, netbox
+from lib import billboard, general, netbox, prefixes
+
+ALL_PATH_TYPES = ["prod_global", "monitor", "site_local", "int_local"]
 
 
 def get_args():
@@ -16,15 +22,33 @@ def get_args():
         description="This python script queries Netbox API and Billboard Cloud to announce "
         "or withdraw paths via Billboard CLI. To run against your local Billboard environment, add the '-local' flag. "
         "To run in production, add the '-prod' flag. To only print out the CLI commands, do not pass any flags. "
-        "Example command: python bb-paths.py announce mad01-data01 -type prod_global,monitor -prod"
+        "Example command: python bb-paths.py announce mad01-data01 -type prod_global,monitor -prod. "
+        "Many devices, or every device of a site or region, can be handled at once: "
+        "python bb-paths.py sync -region Europe -type all"
     )
     parser.add_argument(
-        "action", action="store", help="[announce|withdraw] Indicate action."
+        "action",
+        action="store",
+        help="[announce|withdraw|sync] Indicate action. sync only announces the paths "
+        "missing from Billboard and withdraws the ones Netbox no longer has.",
     )
     parser.add_argument(
         "device_name",
         action="store",
-        help="Indicate valid POP device. Example: mad01-data01",
+        nargs="*",
+        help="Indicate valid POP device(s), space or comma separated. Example: mad01-data01",
+    )
+    parser.add_argument(
+        "-site",
+        default="",
+        dest="site",
+        help="Also handle every Billboard device of these comma separated sites. Example: -site mad01,iad01",
+    )
+    parser.add_argument(
+        "-region",
+        default="",
+        dest="region",
+        help="Also handle every Billboard device of a region. Example: -region Europe",
     )
     parser.add_argument(
         "-type",
@@ -50,17 +74,60 @@ def get_args():
         dest="prod_mode",
         help="Indicates production mode. WARNING: Billboard CLI commands will be executed.",
     )
+    parser.add_argument(
+        "-force",
+        "--force",
+        default=False,
+        action="store_true",
+        dest="force",
+        help="Let sync withdraw paths even when Netbox or Billboard returned no matching desired "
+        "paths for a device.",
+    )
+
+    parser.add_argument(
+        "-workers",
+        default=8,
+        type=int,
+        dest="workers",
+        help="Number of sites queried from Netbox at once, and of Billboard CLI commands run at "
+        "once in -local or -prod mode. Default: 8",
+    )
+    parser.add_argument(
+        "-rate",
+        default=10.0,
+        type=float,
+        dest="rate",
+        help="Maximum Billboard CLI commands started per second, 0 for no limit. Default: 10",
+    )
+    parser.add_argument(
+        "-timeout",
+        default=60.0,
+        type=float,
+        dest="timeout",
+        help="Seconds before a Billboard CLI command is killed. Default: 60",
+    )
+    parser.add_argument(
+        "-retries",
+        default=2,
+        type=int,
+        dest="retries",
+        help="Times a failed or timed out Billboard CLI command is retried, with exponential "
+        "backoff. Default: 2",
+    )
 
     args = parser.parse_args()
 
-    if args.action.lower() not in ["announce", "withdraw"]:
-        raise parser.error("Action must be withdraw or announce!")
+    if args.action.lower() not in ["announce", "withdraw", "sync"]:
+        raise parser.error("Action must be withdraw, announce or sync!")
 
     path_filters = args.path_filter.lower()
     supported_paths = ["prod_global", "monitor", "site_local", "int_local", "all"]
     if not all(i in supported_paths for i in path_filters.split(",")):
         raise parser.error("All filtered paths must be valid: %s" % supported_paths)
 
+    if not args.device_name and not args.site and not args.region:
+        raise parser.error("Indicate a device, -site or -region!")
+
     if args.prod_mode and args.local_mode:
         raise parser.error("You cannot pass both -prod and -local flags at once!")
 
@@ -76,12 +143,15 @@ def find_device_int(device, peer_list):
     netbox_tag = "circuit-interface-ip"
     nb_circuit_ips = nb.query_ips(device=device, tag=netbox_tag)
 
+    # Index the circuit subnets once, each peer then takes the most specific match
+    circuit_subnets = prefixes.PrefixIndex()
+    for circuit_ip in nb_circuit_ips:
+        circuit_subnets.add(circuit_ip["ip"], circuit_ip["interface"])
+
     for peer in peer_list:
-        for circuit_ip in nb_circuit_ips:
-            ip = netaddr.IPNetwork(circuit_ip["ip"])
-            network = ip.cidr
-            if netaddr.IPAddress(peer["peer_ip"]) in network:
-                peer["interface"] = circuit_ip["interface"]
+        interface = circuit_subnets.lookup(peer["peer_ip"])
+        if interface is not None:
+            peer["interface"] = interface
     return None
 
 
@@ -105,54 +175,97 @@ def find_int_local_paths(device, peer_list):
     return None
 
 
-def find_other_paths(site_name, peer_list):
+def query_global_paths(path_filters):
     """
-    Query Netbox for PROD_GLOBAL, MONITOR, and SITE_LOCAL ranges and populate
+    Query Netbox for the PROD_GLOBAL and MONITOR ranges, which are the same for every site.
+    Returns the paths by ip_type
     """
+    global_paths = {"4": [], "6": []}
+    if "prod_global" in path_filters:
+        global_paths["4"].extend(
+            {"cidr": str(i), "path_type": "prod_global"}
+            for i in nb.query_prefixes(family=4, role="production-anycast-range")
+        )
+        global_paths["6"].extend(
+            {"cidr": str(i), "path_type": "prod_global"}
+            for i in nb.query_prefixes(family=6, role="production-anycast-range")
+        )
+    if "monitor" in path_filters:
+        global_paths["4"].extend(
+            {"cidr": str(i), "path_type": "monitor"}
+            for i in nb.query_prefixes(family=4, role="qos-anycast-range")
+        )
+    return global_paths
 
-    nb_prod_global_ipv4 = [
-        {"cidr": str(i), "path_type": "prod_global"}
-        for i in nb.query_prefixes(family=4, role="production-anycast-range")
-    ]
-    nb_prod_global_ipv6 = [
-        {"cidr": str(i), "path_type": "prod_global"}
-        for i in nb.query_prefixes(family=6, role="production-anycast-range")
-    ]
-    nb_monitor_ipv4 = [
-        {"cidr": str(i), "path_type": "monitor"}
-        for i in nb.query_prefixes(family=4, role="qos-anycast-range")
-    ]
-    nb_site_local_ipv4 = [
+
+def query_site_paths(site_name, path_filters):
+    """
+    Query Netbox for the SITE_LOCAL ranges of a site. Returns the paths by ip_type
+    """
+    site_paths = {"4": [], "6": []}
+    if "site_local" not in path_filters:
+        return site_paths
+    site_paths["4"].extend(
         {"cidr": str(i), "path_type": "site_local"}
         for i in nb.query_prefixes(
             site=site_name, family=4, role="ipv4-site-local-range"
         )
-    ]
-    nb_site_local_ipv6 = [
+    )
+    site_paths["6"].extend(
         {"cidr": str(i), "path_type": "site_local"}
         for i in nb.query_prefixes(
             site=site_name, family=6, role="ipv6-site-local-range"
         )
-    ]
-    nb_site_ipv6 = [
+    )
+    site_paths["6"].extend(
         {"cidr": str(i), "path_type": "site_local"}
         for i in nb.query_prefixes(site=site_name, family=6, role="ipv6-site-range")
-    ]
+    )
+    return site_paths
 
-    # Loop through each peer, attach rangs to paths list for matching address type
+
+def find_other_paths(site_name, peer_list, global_paths=None, site_paths=None):
+    """
+    Query Netbox for PROD_GLOBAL, MONITOR, and SITE_LOCAL ranges and populate.
+    Ranges already queried for other devices can be passed in as global_paths and site_paths
+    """
+    if global_paths is None:
+        global_paths = query_global_paths(ALL_PATH_TYPES)
+    if site_paths is None:
+        site_paths = query_site_paths(site_name, ALL_PATH_TYPES)
+
+    # Loop through each peer, attach ranges to paths list for matching address type
     for peer in peer_list:
-        if peer["ip_type"] == "4":
-            peer["paths"].extend(nb_prod_global_ipv4)
-            peer["paths"].extend(nb_monitor_ipv4)
-            peer["paths"].extend(nb_site_local_ipv4)
-        elif peer["ip_type"] == "6":
-            peer["paths"].extend(nb_prod_global_ipv6)
-            peer["paths"].extend(nb_site_local_ipv6)
-            peer["paths"].extend(nb_site_ipv6)
+        peer["paths"].extend(global_paths.get(peer["ip_type"], []))
+        peer["paths"].extend(site_paths.get(peer["ip_type"], []))
 
     return None
 
 
+def check_output(command, output):
+    """
+    Raise when a Billboard CLI query failed, so an empty answer is never taken for no data
+    """
+    if output.returncode != 0:
+        raise RuntimeError(
+            "%s failed with exit code %s: %s"
+            % (" ".join(command), output.returncode, output.stderr.strip())
+        )
+
+
+def bb_query_hostnames():
+    """
+    Query every device with peers configured using Billboard CLI tool
+    """
+    command = ["billboard", "get", "peer"]
+
+    output = subprocess.run(
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    check_output(command, output)
+    return billboard.parse_peer_hostnames(output.stdout)
+
+
 def bb_query_peers(site_name, device):
     """
     Query device peer info using  Billboard CLI tool
@@ -174,6 +287,7 @@ def bb_query_peers(site_name, device):
     output = subprocess.run(
         command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
     )
+    check_output(command, output)
 
     # Parse through output and grab device, peer-ip, peer_type info, figure out if each is ipv4 or ipv6
     # Using range [1:-1] to ignore first line containing column names and last line containing empty line
@@ -203,6 +317,7 @@ def bb_query_paths(device):
     output = subprocess.run(
         command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
     )
+    check_output(command, output)
     path_list = []
     for line in output.stdout.split("\n")[1:-1]:
         device, _, _, peer_ip, prefix, prefix_len, path_type, _, _, *_ = line.split()
@@ -256,9 +371,9 @@ def bb_withdraw_command(path_info):
     return path_command
 
 
-def announce(site_name, device, path_filters):
+def find_peer_paths(site_name, device, global_paths=None, site_paths=None):
     """
-    For announcing paths using Netbox data. Returns list with Billboard CLI commands
+    Builds the Billboard peers of a device with the paths Netbox says each one should have
     """
     # Find all peers configured in Billboard for device
     peer_list = bb_query_peers(site_name=site_name, device=device)
@@ -270,7 +385,26 @@ def announce(site_name, device, path_filters):
     find_int_local_paths(device=device, peer_list=peer_list)
 
     # Find PROD_GLOBAL, MONITOR, SITE_LOCAL paths and update peer
-    find_other_paths(site_name=site_name, peer_list=peer_list)
+    find_other_paths(
+        site_name=site_name,
+        peer_list=peer_list,
+        global_paths=global_paths,
+        site_paths=site_paths,
+    )
+
+    return peer_list
+
+
+def announce(site_name, device, path_filters, global_paths=None, site_paths=None):
+    """
+    For announcing paths using Netbox data. Returns list with Billboard CLI commands
+    """
+    peer_list = find_peer_paths(
+        site_name=site_name,
+        device=device,
+        global_paths=global_paths,
+        site_paths=site_paths,
+    )
 
     # Craft Billboard path commands
     path_command_list = []
@@ -303,6 +437,230 @@ def withdraw(device, path_filters):
     return path_command_list
 
 
+def path_key(peer_ip, prefix, prefix_len):
+    """
+    Normalized (peer_ip, cidr) of a path, so Netbox and Billboard spellings compare equal
+    """
+    cidr = netaddr.IPNetwork("%s/%s" % (prefix, prefix_len)).cidr
+    return str(netaddr.IPAddress(peer_ip)), str(cidr)
+
+
+def sync(
+    site_name, device, path_filters, global_paths=None, site_paths=None, force=False
+):
+    """
+    For reconciling Billboard with Netbox. Returns list with the Billboard CLI commands announcing
+    the paths Billboard is missing or has with another type, and withdrawing the paths Netbox no
+    longer has, plus the number of paths already in sync.
+    Paths are compared by (peer_ip, cidr): a type change is one re-announce, never a withdraw.
+    """
+    # Desired state: every Netbox path of every peer, of any type so a path filtered out
+    # of this run is never withdrawn
+    desired = {}
+    peer_list = find_peer_paths(
+        site_name=site_name,
+        device=device,
+        global_paths=global_paths,
+        site_paths=site_paths,
+    )
+    for peer in peer_list:
+        for path in peer["paths"]:
+            prefix, prefix_len = path["cidr"].split("/")
+            desired[path_key(peer["peer_ip"], prefix, prefix_len)] = (peer, path)
+
+    # Current state: the paths Billboard has for the device
+    current = {}
+    for path in bb_query_paths(device):
+        if path["path_type"].lower() in path_filters and path["device"] == device:
+            key = path_key(path["peer_ip"], path["prefix"], path["prefix_len"])
+            current[key] = path
+
+    # Craft Billboard path commands for the difference only
+    path_command_list = []
+    in_sync = 0
+    for key, (peer, path) in desired.items():
+        if path["path_type"] not in path_filters:
+            continue
+        if key in current and current[key]["path_type"].lower() == path["path_type"]:
+            in_sync += 1
+            continue
+        path_command = bb_announce_command(
+            device=peer["device"], peer_ip=peer["peer_ip"], path_info=path
+        )
+        path_command_list.append(path_command)
+
+    stale = [path for key, path in current.items() if key not in desired]
+    # Fail closed: an empty or unrelated desired state most likely means a failed lookup,
+    # withdrawing on it would remove every path of the device
+    unresolved = not peer_list or not desired or not desired.keys() & current.keys()
+    if stale and unresolved and not force:
+        print(
+            "Refusing to withdraw %s paths of %s: Netbox/Billboard returned no matching "
+            "desired paths. Pass -force to withdraw anyway." % (len(stale), device),
+            file=sys.stderr,
+        )
+        stale = []
+    for path in stale:
+        path_command_list.append(bb_withdraw_command(path_info=path))
+
+    return path_command_list, in_sync
+
+
+class RateLimiter:
+    """
+    Spaces out the start of Billboard CLI commands to at most rate per second across all workers
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        time.sleep(start - now)
+
+
+def run_bb_command(command, limiter, timeout, retries, backoff=1.0):
+    """
+    Run one Billboard CLI command, answering its confirmation prompt. Failures and timeouts are
+    retried with exponential backoff. Returns the error of the last attempt, empty on success
+    """
+    error = ""
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        limiter.wait()
+        try:
+            result = subprocess.run(
+                command,
+                input="y\n",
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            error = "timed out after %ss" % timeout
+            continue
+        except OSError as e:
+            # the CLI can't be started, retrying won't help
+            return str(e)
+        if result.returncode == 0:
+            return ""
+        last_line = result.stdout.strip().split("\n")[-1]
+        error = "exit code %s: %s" % (result.returncode, last_line)
+    return error
+
+
+def execute_commands(command_list, workers, rate, timeout, retries):
+    """
+    Run the Billboard CLI commands through a bounded worker pool. Returns (command, error) of every
+    command that still failed after its retries
+    """
+    limiter = RateLimiter(rate)
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(run_bb_command, i, limiter, timeout, retries): i
+            for i in command_list
+        }
+        for future in as_completed(futures):
+            command = futures[future]
+            error = future.result()
+            if error:
+                failures.append((command, error))
+                print("FAILED: %s (%s)" % (" ".join(command), error))
+            else:
+                print(" ".join(command))
+    return failures
+
+
+def print_failure_summary(command_list, failures):
+    print(
+        "\n%s of %s commands succeeded"
+        % (len(command_list) - len(failures), len(command_list))
+    )
+    if failures:
+        print("Failed commands:")
+        for command, error in failures:
+            print("  %s\n    %s" % (" ".join(command), error))
+
+
+def select_devices(device_names, sites="", region=""):
+    """
+    Expand the device names plus a site and/or region selector into (device_name, site_name) pairs
+    """
+    names = [i for name in device_names for i in name.split(",") if i]
+    if sites or region:
+        site_list = [i.strip().lower() for i in sites.split(",") if i.strip()]
+        names += billboard.select_hostnames(bb_query_hostnames(), site_list, region)
+
+    devices = []
+    for name in names:
+        device = general.get_server_site(name)
+        if device not in devices:
+            devices.append(device)
+    return devices
+
+
+def queried_path_types(action, path_filters):
+    """
+    Path types to query from Netbox. sync needs every type for a complete desired state, so a
+    path Netbox still wants under another type is never withdrawn; path_filters only limit
+    its commands
+    """
+    if action == "sync":
+        return ALL_PATH_TYPES
+    return path_filters
+
+
+def site_commands(
+    action, site_name, devices, path_filters, global_paths=None, force=False
+):
+    """
+    Craft the Billboard CLI commands of every device of a site, querying the site ranges once
+    """
+    site_paths = None
+    if action != "withdraw":
+        site_paths = query_site_paths(
+            site_name, queried_path_types(action, path_filters)
+        )
+
+    command_list = []
+    for device_name in devices:
+        if action == "announce":
+            command_list += announce(
+                site_name=site_name,
+                device=device_name,
+                path_filters=path_filters,
+                global_paths=global_paths,
+                site_paths=site_paths,
+            )
+        elif action == "withdraw":
+            command_list += withdraw(device=device_name, path_filters=path_filters)
+        elif action == "sync":
+            commands, in_sync = sync(
+                site_name=site_name,
+                device=device_name,
+                path_filters=path_filters,
+                global_paths=global_paths,
+                site_paths=site_paths,
+                force=force,
+            )
+            print(
+                "%s paths in sync, %s commands to reconcile %s"
+                % (in_sync, len(commands), device_name)
+            )
+            command_list += commands
+    return command_list
+
+
 def main():
     args = get_args()
     general.preliminary_checks(
@@ -314,52 +672,65 @@ def main():
     # device_name = args.device_name.lower()
     action = args.action.lower()
     path_filters = args.path_filter.split(",")
-    all_path_types = ["prod_global", "monitor", "site_local", "int_local"]
     # Check path filter
     if path_filters == ["all"]:
-        path_filters = all_path_types
+        path_filters = ALL_PATH_TYPES
     local_mode = args.local_mode
     prod_mode = args.prod_mode
 
-    device_name, site_name = general.get_server_site(args.device_name)
-
-    # Perform withdraw or announce action
-    if action == "announce":
-        command_list = announce(
-            site_name=site_name, device=device_name, path_filters=path_filters
+    devices = select_devices(
+        device_names=args.device_name, sites=args.site, region=args.region
+    )
+    if not devices:
+        print("No devices matched the selection")
+        sys.exit(1)
+
+    # The global ranges are the same for every device, query them once
+    global_paths = None
+    if action != "withdraw":
+        global_paths = query_global_paths(queried_path_types(action, path_filters))
+
+    # Query each site in parallel, every device of a site shares its ranges
+    sites = {}
+    for device_name, site_name in devices:
+        sites.setdefault(site_name, []).append(device_name)
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        site_command_lists = pool.map(
+            lambda site: site_commands(
+                action=action,
+                site_name=site,
+                devices=sites[site],
+                path_filters=path_filters,
+                global_paths=global_paths,
+                force=args.force,
+            ),
+            sites,
         )
-    elif action == "withdraw":
-        command_list = withdraw(device=device_name, path_filters=path_filters)
+        command_list = [i for commands in site_command_lists for i in commands]
 
-    # Check for prod_mode before processing commands
-    for i in command_list:
-
-        if local_mode:
-            local_flags = ["--host", "localhost", "--port", "55010"]
-            i.extend(local_flags)
-            print(" ".join(i))
-            p = subprocess.Popen(
-                i,
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-            )
-            p.communicate(input="y\n")
-        elif prod_mode:
+    # Only print the commands unless running against local or production Billboard
+    if not local_mode and not prod_mode:
+        for i in command_list:
             print(" ".join(i))
-            print("WE'LL DO IT LIVE!")
-            p = subprocess.Popen(
-                i,
-                stdout=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-            )
-            p.communicate(input="y\n")
+        return
 
-        else:
-            print(" ".join(i))
+    if local_mode:
+        local_flags = ["--host", "localhost", "--port", "55010"]
+        for i in command_list:
+            i.extend(local_flags)
+    elif prod_mode:
+        print("WE'LL DO IT LIVE!")
+
+    failures = execute_commands(
+        command_list=command_list,
+        workers=args.workers,
+        rate=args.rate,
+        timeout=args.timeout,
+        retries=args.retries,
+    )
+    print_failure_summary(command_list=command_list, failures=failures)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -6,45 +6,144 @@ This tool is used to check an interface for RX, TX, CRC Errors, Light Levels, an
 
 
 import argparse
+import asyncio
+import atexit
+import contextlib
+import inspect
+import itertools
+import json
+import math
+import os
 import re
+import shutil
+import sqlite3
 import sys
+import tempfile
 import threading
 import time
+from collections import deque
 from dataclasses import dataclass
-from subprocess import PIPE, Popen
+from subprocess import DEVNULL, PIPE, Popen
 
+import pynetbox
 from bullet import Bullet, Check, colors
-from netaddr import IPNetwork
 from tcolorpy import tcolor
 
-from lib import netbox
+from lib import (
+    billboard,
+    collector,
+    history,
+    netbox,
+    netstats,
+    optics,
+    peers,
+    profiling,
+    replay,
+    thresholds,
+)
+
+NETBOX_URL = "https://netbox.global.ftlprod.net"
+SSH_PARAMETERS = "ssh -q -o StrictHostKeyChecking=no"
+SSH_TRAILER = ".pop.ftlprod.net"
+# a Unix socket path holds 104 bytes on macOS (108 on Linux), the ControlPath adds
+# "/" and the 40 character %C hash, ssh a 17 character suffix while starting the master
+CONTROL_DIR_MAX = 104 - 1 - 40 - 17
+# seconds an idle master connection stays up, a killed run leaves none behind for long
+CONTROL_PERSIST = 60
+HISTORY_DB = os.path.expanduser("~/.interface_checker.db")
+OUTPUT_FORMATS = ("text", "json", "ndjson")
+# exit codes of the non-interactive modes, 1 stays bad input or nothing to check
+EXIT_CLEAN = 0
+EXIT_PROBLEMS = 2
+EXIT_INCOMPLETE = 3
+# triage verdicts of interfaces that get no deep checks
+TRIAGE_SKIPPED = ("clean", "down", "unknown")
+PING_COUNT = 5000
+PING_BATCH = 250
+# one sided 95% confidence for the adaptive packet loss test
+LOSS_CONFIDENCE_Z = 1.645
+BATCH_MARKER = "###"
+BATCH_PROBES = [
+    ("link", "sudo ip link show $i"),
+    ("speed", "cat /sys/class/net/$i/speed 2>/dev/null"),
+    ("module", "sudo ethtool -m $i 2>/dev/null"),
+    ("clock", "date +%s.%N"),
+    ("sysfs", "grep . /sys/class/net/$i/statistics/*"),
+    ("stats", "sudo ethtool -S $i"),
+]
+# Interface fields filled from Netbox, kept in the replay fixtures
+NETBOX_FIELDS = ("name", "mac", "circuit_id", "provider", "status", "itype", "ip")
+SERVER_PROBES = [("addresses", "ip -br a")]
+# what the remote collection agent reads for each batch probe
+AGENT_PROBES = {
+    "link": "link",
+    "speed": "speed",
+    "module": "module",
+    "clock": "counters",
+    "sysfs": "counters",
+    "stats": "counters",
+    "addresses": "addresses",
+}
+COUNTER_PROBES = [
+    ("clock", "date +%s.%N"),
+    ("sysfs", "grep . /sys/class/net/$i/statistics/*"),
+    ("stats", "sudo ethtool -S $i"),
+]
 
-animate_timer = 0
 interfaces = {}
+ssh_control_dir = ""
+ssh_sessions = set()
+ssh_session_locks = {}
+ssh_sessions_lock = threading.Lock()
+ssh_session_async_locks = {}
+probe_timeout = 300
+adaptive_loss = False
+agent_collection = False
+triage_mode = False
+history_db = HISTORY_DB
+threshold_profiles = thresholds.Profiles()
+profiler = profiling.Profiler()
+sample_window = 30
+window_start = {}
+# Billboard peers of every server looked up this run, and their fetches in flight
+peer_indexes = {}
+peer_fetches = {}
+output_format = "text"
 
 
 @dataclass
 class Interface:
     name: str = ""
+    server: str = ""
     mac: str = ""
     circuit_id: str = ""
     provider: str = ""
     status: str = ""
     itype: str = ""
     ip: str = ""
+    source_ip: str = ""
     light_level: str = ""
     speed: str = ""
+    optic: str = ""
+    module: optics.ModuleDom = None
     before_rx_errors: str = ""
     after_rx_errors: str = ""
     before_tx_errors: str = ""
     after_tx_errors: str = ""
     before_crc_errors: str = ""
     after_crc_errors: str = ""
+    before_counters: netstats.CounterSnapshot = None
+    after_counters: netstats.CounterSnapshot = None
     packet_loss: str = ""
     state: str = ""
     raw_packet_loss: str = ""
     raw_light_level: str = ""
     problem: str = ""
+    # why the packet loss check failed, the other checks still report
+    loss_error: str = ""
+    # --triage verdict (clean, suspicious or down) and why
+    triage: str = ""
+    triage_reason: str = ""
 
 
 def arg_parse() -> object:
@@ -60,6 +159,189 @@ def arg_parse() -> object:
         required=False,
         help="Interface of the server to test",
     )
+    group.add_argument(
+        "-w",
+        "--window",
+        metavar="",
+        type=int,
+        default=30,
+        help="Seconds to sample the incrementing error counters (default: 30)",
+    )
+    group.add_argument(
+        "-t",
+        "--timeout",
+        metavar="",
+        type=int,
+        default=300,
+        help="Seconds before a probe is cancelled (default: 300)",
+    )
+    group.add_argument(
+        "--format",
+        metavar="",
+        choices=OUTPUT_FORMATS,
+        default="text",
+        help="Output format: text, json or ndjson records written as each "
+        "interface completes (default: text). Exits 2 when problems were found, "
+        "3 when interfaces could not be checked",
+    )
+    group.add_argument(
+        "-a",
+        "--adaptive-loss",
+        action="store_true",
+        help="Stop the packet loss test as soon as the result is statistically clear",
+    )
+    group.add_argument(
+        "--triage",
+        action="store_true",
+        help="Only run the packet loss and error checks on interfaces that look suspicious",
+    )
+    group.add_argument(
+        "--thresholds",
+        metavar="",
+        default="",
+        help="JSON file with per optic, speed and provider threshold profiles",
+    )
+    group.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print p50/p95 timings of every command type, lookup and check at exit",
+    )
+    group.add_argument(
+        "--trace",
+        metavar="",
+        default="",
+        help="Write every timing span to this file (Chrome trace format)",
+    )
+    group.add_argument(
+        "--agent",
+        action="store_true",
+        help="Collect interface data with the remote Python agent instead of shell probes",
+    )
+    offline = parser.add_argument_group("Record and replay")
+    offline.add_argument(
+        "--record",
+        metavar="",
+        default="",
+        help="Directory to save the command outputs and Netbox data of this run in",
+    )
+    offline.add_argument(
+        "--replay",
+        metavar="",
+        default="",
+        help="Directory of recorded fixtures to answer every command from, offline",
+    )
+    offline.add_argument(
+        "--replay-latency",
+        metavar="",
+        type=float,
+        default=0.0,
+        help="Seconds every replayed command takes (default: 0)",
+    )
+    offline.add_argument(
+        "--replay-jitter",
+        metavar="",
+        type=float,
+        default=0.0,
+        help="Up to this many extra seconds per replayed command (default: 0)",
+    )
+    watch = parser.add_argument_group("Watch mode")
+    watch.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep polling the server (or --interface) until Ctrl-C",
+    )
+    watch.add_argument(
+        "--interval",
+        metavar="",
+        type=int,
+        default=10,
+        help="Seconds between polls (default: 10)",
+    )
+    watch.add_argument(
+        "--history",
+        metavar="",
+        type=int,
+        default=30,
+        help="Number of polls kept in the sliding window (default: 30)",
+    )
+    watch.add_argument(
+        "--watch-pings",
+        metavar="",
+        type=int,
+        default=100,
+        help="Flood ping packets sent per interface on every poll (default: 100)",
+    )
+    store = parser.add_argument_group("History")
+    store.add_argument(
+        "--db",
+        metavar="",
+        default="",
+        help=f"SQLite file every result is recorded in (default: {HISTORY_DB}, "
+        "nothing is recorded with --replay unless --db is given)",
+    )
+    store.add_argument(
+        "--no-record",
+        action="store_true",
+        help="Do not record the results of this run",
+    )
+    store.add_argument(
+        "--trend",
+        action="store_true",
+        help="Show the light level trend of the recorded interfaces (filtered by -s/-i)",
+    )
+    store.add_argument(
+        "--days",
+        metavar="",
+        type=float,
+        default=30,
+        help="Days of history used by --trend (default: 30)",
+    )
+    fleet = parser.add_argument_group("Fleet sweep")
+    fleet.add_argument(
+        "--servers",
+        metavar="",
+        default="",
+        help="Comma separated list of servers to sweep",
+    )
+    fleet.add_argument(
+        "--servers-file",
+        metavar="",
+        default="",
+        help="File with one server per line to sweep ('-' reads stdin)",
+    )
+    fleet.add_argument(
+        "--site",
+        metavar="",
+        default="",
+        help="Comma separated list of sites to sweep (e.g. iad01,mad01)",
+    )
+    fleet.add_argument(
+        "--region",
+        metavar="",
+        default="",
+        help="Region to sweep (e.g. Europe)",
+    )
+    fleet.add_argument(
+        "--batch",
+        metavar="",
+        default="",
+        help="File of 'server interface' pairs or circuit IDs, one per line, to "
+        "check with NDJSON output ('-' reads stdin)",
+    )
+    fleet.add_argument(
+        "--host-concurrency",
+        metavar="",
+        type=int,
+        default=8,
+        help="Maximum concurrent probes per server (default: 8)",
+    )
+    fleet.add_argument(
+        "--global-concurrency",
+        metavar="",
+        type=int,
+        default=64,
+        help="Maximum concurrent probes across the fleet (default: 64)",
+    )
     parser.add_argument(
         "-v",
         "--version",
@@ -77,164 +359,510 @@ def print_complete(msg: str):
     print(tcolor("]", color="white"))
 
 
-def send_command_to_server(cmd: str, server="", itype="server") -> str:
-    """Sending out the hopper command over SSH to retrieve the path_info data"""
-    trailer = ".pop.ftlprod.net "
-    ssh_parameters = "ssh -q -o StrictHostKeyChecking=no"
-    access_command = f"{ssh_parameters} {server}{trailer}"
-    if itype == "server":
-        server_command = access_command + cmd
-    else:
-        server_command = cmd
+def ssh_control_options() -> str:
+    """ssh options sharing one master connection per server, none when the socket
+    path would not fit"""
+    global ssh_control_dir
+    with ssh_sessions_lock:
+        if not ssh_control_dir:
+            # not $TMPDIR, it can be too long for a socket path (e.g. macOS)
+            base = "/tmp" if os.path.isdir("/tmp") else None
+            ssh_control_dir = tempfile.mkdtemp(prefix="ic-", dir=base)
+            atexit.register(close_ssh_sessions)
+    if len(ssh_control_dir) > CONTROL_DIR_MAX:
+        return ""
     return (
-        Popen(server_command.split(), stdout=PIPE)
-        .communicate()[0]
-        .decode("utf-8")
-        .rstrip("\n")
+        f"-o ControlMaster=auto -o ControlPersist={CONTROL_PERSIST} "
+        f"-o ControlPath={ssh_control_dir}/%C"
     )
 
 
-def is_interface_up(server: str, interface: str) -> int:
-    """Checks to see if an interface is UP or DOWN"""
-    global animate_timer
-    cmd = "sudo ip -s link show " + interface
-    result = send_command_to_server(cmd, server)
+def server_command_args(cmd: str, server="", itype="server") -> list:
+    if itype == "server":
+        access_command = (
+            f"{SSH_PARAMETERS} {ssh_control_options()} {server}{SSH_TRAILER} "
+        )
+        return (access_command + cmd).split()
+    return cmd.split()
+
+
+def master_command_args(server: str) -> list:
+    master_command = (
+        f"{SSH_PARAMETERS} {ssh_control_options()} -f -N {server}{SSH_TRAILER}"
+    )
+    return master_command.split()
+
+
+def open_ssh_session(server: str):
+    """Opens one authenticated master connection per server for every command to share"""
+    with ssh_sessions_lock:
+        session_lock = ssh_session_locks.setdefault(server, threading.Lock())
+    with session_lock:
+        if server in ssh_sessions or not ssh_control_options():
+            return
+        Popen(master_command_args(server), stderr=DEVNULL).wait()
+        ssh_sessions.add(server)
+
+
+async def open_ssh_session_async(server: str):
+    """open_ssh_session for the probe engine, waiting probes don't block the event loop"""
+    session_lock = ssh_session_async_locks.setdefault(server, asyncio.Lock())
+    async with session_lock:
+        if server in ssh_sessions or not ssh_control_options():
+            return
+        process = await asyncio.create_subprocess_exec(
+            *master_command_args(server), stderr=DEVNULL
+        )
+        await process.wait()
+        ssh_sessions.add(server)
+
+
+def close_ssh_sessions():
+    """Tears down the master connections opened during this run"""
+    for server in ssh_sessions:
+        exit_command = (
+            f"{SSH_PARAMETERS} {ssh_control_options()} -O exit {server}{SSH_TRAILER}"
+        )
+        Popen(exit_command.split(), stderr=DEVNULL).wait()
+    shutil.rmtree(ssh_control_dir, ignore_errors=True)
+
+
+class SSHTransport:
+    """
+    Runs the commands over the shared SSH session of the server, or locally
+    """
+
+    def send(self, cmd: str, server="", itype="server") -> str:
+        if itype == "server":
+            open_ssh_session(server)
+        return (
+            Popen(server_command_args(cmd, server, itype), stdout=PIPE)
+            .communicate()[0]
+            .decode("utf-8")
+            .rstrip("\n")
+        )
+
+    async def run(self, cmd: str, server="", itype="server") -> str:
+        if itype == "server":
+            await open_ssh_session_async(server)
+        process = await asyncio.create_subprocess_exec(
+            *server_command_args(cmd, server, itype), stdout=PIPE
+        )
+        try:
+            stdout, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        return stdout.decode("utf-8").rstrip("\n")
+
+    async def stream(self, cmd: str, server="", itype="server", stdin=b""):
+        if itype == "server":
+            await open_ssh_session_async(server)
+        process = await asyncio.create_subprocess_exec(
+            *server_command_args(cmd, server, itype), stdin=PIPE, stdout=PIPE
+        )
+        try:
+            process.stdin.write(stdin)
+            await process.stdin.drain()
+            process.stdin.close()
+            async for line in process.stdout:
+                yield line.decode("utf-8").rstrip("\n")
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+
+    def netbox_interfaces(self, server: str, mode: str) -> list:
+        """Live runs read the interfaces from Netbox"""
+        return None
+
+    def save_netbox_interfaces(self, server: str, mode: str, rows: list):
+        pass
+
+
+# replaced by a replay.Recorder or replay.Replayer with --record / --replay
+transport = SSHTransport()
+
+
+def send_command_to_server(cmd: str, server="", itype="server") -> str:
+    """Sending out the command over the transport (SSH, recorder or replay)"""
+    with profiler.span("command", profiling.command_type(cmd), server=server):
+        return transport.send(cmd, server, itype)
+
+
+async def run_command(cmd: str, server="", itype="server") -> str:
+    """Async send_command_to_server, the command is killed if the probe is cancelled"""
+    with profiler.span("command", profiling.command_type(cmd), server=server):
+        return await transport.run(cmd, server, itype)
+
+
+async def stream_command(cmd: str, server="", itype="server", stdin=b""):
+    """Yields the output lines of a command as they arrive, stdin is sent up front"""
+    with profiler.span("command", profiling.command_type(cmd), server=server):
+        async for line in transport.stream(cmd, server, itype, stdin):
+            yield line
+
+
+def parse_link_state(result: str) -> str:
+    """Returns UP or DOWN from the output of ip link show"""
     match = re.search(r"(\w+) mode", result)
     if match is not None:
         if "UP" == match.group(0).replace(" mode", ""):
-            interfaces[interface].state = "UP"
-        else:
-            interfaces[interface].state = "DOWN"
-    else:
-        print(f"Could not verify {interface} on {server}")
-        return
-    animate_timer += 1
+            return "UP"
+        return "DOWN"
+    return ""
 
 
-def check_int_speed(server: str, interface: str) -> str:
-    cmd = f"sudo ethtool {interface} | grep Speed"
-    result = send_command_to_server(cmd, server)
-    if re.search("10000Mb/s", result):
+def parse_int_speed(result: str) -> str:
+    """Returns 10G or 100G from /sys/class/net/<iface>/speed (Mb/s)"""
+    if result.strip() == "10000":
         return "10G"
     else:
         return "100G"
 
 
-def check_light_levels(server: str, interface: list):
-    """Updates Interface Class with light level of interface"""
-    global animate_timer
-    interfaces[interface].speed = check_int_speed(server, interface)
-    if interfaces[interface].speed == "10G":
-        receiver = '| grep "Receiver signal average optical power  "'
-    else:
-        receiver = '| grep "Rcvr signal avg optical power"'
-    cmd = "sudo ethtool -m " + interface.lower() + receiver
-    result = send_command_to_server(cmd, server)
-    interfaces[interface].raw_light_level = result
-    match = re.search(r"(\d+.\d\d) dBm", result)
-    if match is not None:
-        if interfaces[interface].speed == "10G":
-            interfaces[interface].light_level = float(
-                match.group(0).replace(" dBm", "")
-            )
-        else:
-            interfaces[interface].light_level = [
-                x.replace("/ ", "")
-                for x in re.findall(
-                    r"(/ (?:.|\s|\d+)(?:.|\s|\d+)(?:.|\s|\d+)\d+)", result, re.MULTILINE
-                )
-            ]
-    else:
-        interfaces[interface].light_level = -99
-    animate_timer += 1
+def module_light_level(module: optics.ModuleDom, speed: str) -> tuple:
+    """Returns the receiver power of every lane as text and the light level in dBm"""
+    raw_light_level = " ".join(f"{x} dBm" for x in module.rx_power)
+    if not module.rx_power:
+        return raw_light_level, -99
+    if speed == "10G":
+        return raw_light_level, module.rx_power[0]
+    return raw_light_level, [str(x) for x in module.rx_power]
 
 
-def get_interface_ip(server: str, interface: list) -> str:
-    """returns the ipv4 on a given interface"""
-    cmd = "ip -br a | grep " + interface.lower()
-    result = send_command_to_server(cmd, server)
-    match = re.search(r"(\d+).(\d+).(\d+).(\d+)/", result)
-    if match is not None:
-        return match.group(0).replace("/", "")
+def parse_interface_ip(result: str, interface: str) -> str:
+    """Returns the ipv4 of an interface from the output of ip -br a"""
+    for line in result.split("\n"):
+        fields = line.split()
+        if fields and fields[0] == interface.lower():
+            match = re.search(r"(\d+).(\d+).(\d+).(\d+)/", line)
+            if match is not None:
+                return match.group(0).replace("/", "")
+    return ""
 
 
-def get_circuit_peer_ip(ip: str, server: str) -> str:
-    if "/31" in ip:
-        for ip_addr in IPNetwork(ip):
-            if ip.strip("/31") != ip_addr:
-                return ip_addr
-    else:
-        result = send_command_to_server(
-            f"billboard get peer hostname={server}",
-            server,
-            "local",
+@dataclass
+class InterfaceProbe:
+    name: str = ""
+    state: str = ""
+    speed: str = ""
+    light_level: object = -99
+    raw_light_level: str = ""
+    optic: str = ""
+    module: optics.ModuleDom = None
+    source_ip: str = ""
+    counters: netstats.CounterSnapshot = None
+
+
+def batch_probe_command(
+    interface_list: list,
+    probes: list = BATCH_PROBES,
+    server_probes: list = SERVER_PROBES,
+) -> str:
+    """Builds one remote script that dumps the given probes for all interfaces"""
+    names = " ".join(x.lower() for x in interface_list)
+    script = f"for i in {names}; do "
+    for probe, cmd in probes:
+        script += f'echo "{BATCH_MARKER} $i {probe}"; {cmd}; '
+    script += "done"
+    for probe, cmd in server_probes:
+        script += f'; echo "{BATCH_MARKER} all {probe}"; {cmd}'
+    return script
+
+
+def split_batch_output(result: str) -> dict:
+    """Splits the batch script output into {(interface, probe): output}"""
+    sections = {}
+    section = None
+    for line in result.split("\n"):
+        if line.startswith(BATCH_MARKER + " "):
+            section = tuple(line.split()[1:3])
+            sections[section] = []
+        elif section is not None:
+            sections[section].append(line)
+    return {key: "\n".join(value) for key, value in sections.items()}
+
+
+def agent_command(interface_list: list, probes: list, server_probes: list) -> str:
+    """Command line of the remote agent reading the given probes for all interfaces"""
+    names = []
+    for probe, _ in probes + server_probes:
+        if AGENT_PROBES[probe] not in names:
+            names.append(AGENT_PROBES[probe])
+    interface_names = " ".join(x.lower() for x in interface_list)
+    return f"sudo python3 - {','.join(names)} {interface_names}"
+
+
+def agent_probe(interface: str, record: dict) -> InterfaceProbe:
+    """Builds the InterfaceProbe of one agent record"""
+    probe = InterfaceProbe(name=interface)
+    probe.state = record.get("state", "")
+    probe.speed = "10G" if record.get("speed") == 10000 else "100G"
+    probe.module = optics.parse_module_dom(record.get("module", ""))
+    probe.raw_light_level, probe.light_level = module_light_level(
+        probe.module, probe.speed
+    )
+    probe.optic = probe.module.identifier
+    if "sysfs" in record:
+        probe.counters = netstats.counter_snapshot(
+            interface, record["timestamp"], record["sysfs"], record["ethtool"]
+        )
+    probe.source_ip = record.get("source_ip", "")
+    return probe
+
+
+async def agent_probe_interfaces(
+    server: str, interface_list: list, probes: list, server_probes: list
+) -> dict:
+    """probe_interfaces through the remote agent, each interface is read as it streams in"""
+    names = {x.lower(): x for x in interface_list}
+    cmd = agent_command(interface_list, probes, server_probes)
+    agent = inspect.getsource(collector).encode("utf-8")
+    results = {}
+    async for line in stream_command(cmd, server, stdin=agent):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        interface = names.get(record.get("interface"))
+        if interface is not None:
+            results[interface] = agent_probe(interface, record)
+    return results
+
+
+async def probe_interfaces(
+    server: str,
+    interface_list: list,
+    probes: list = BATCH_PROBES,
+    server_probes: list = SERVER_PROBES,
+) -> dict:
+    """Collects state, speed, light, counters and addresses in a single round trip"""
+    if agent_collection:
+        results = await agent_probe_interfaces(
+            server, interface_list, probes, server_probes
         )
-        if result is not None:
-            return [
-                string
-                for string in result.split()
-                if ".".join(ip.split(".")[0:3]) in string
-            ][0]
+        # servers without python3 fall back to the shell probes
+        if results:
+            return {x: results.get(x, InterfaceProbe(name=x)) for x in interface_list}
+    cmd = batch_probe_command(interface_list, probes, server_probes)
+    result = await run_command(cmd, server)
+    sections = split_batch_output(result)
+    addresses = sections.get(("all", "addresses"), "")
+    probes = {}
+    for interface in interface_list:
+        name = interface.lower()
+        probe = InterfaceProbe(name=interface)
+        probe.state = parse_link_state(sections.get((name, "link"), ""))
+        probe.speed = parse_int_speed(sections.get((name, "speed"), ""))
+        probe.module = optics.parse_module_dom(sections.get((name, "module"), ""))
+        probe.raw_light_level, probe.light_level = module_light_level(
+            probe.module, probe.speed
+        )
+        probe.optic = probe.module.identifier
+        probe.counters = netstats.parse_counter_snapshot(
+            interface,
+            sections.get((name, "clock"), ""),
+            sections.get((name, "sysfs"), ""),
+            sections.get((name, "stats"), ""),
+        )
+        probe.source_ip = parse_interface_ip(addresses, interface)
+        probes[interface] = probe
+    return probes
+
+
+async def collect_interface_data(server: str, interface_list: list):
+    """Updates Interface Class with state, speed, light level and source ip of every interface
+
+    The error counters collected here open the sampling window that
+    check_incrementing_errors closes, so every check run in between overlaps it.
+    """
+    probes = await probe_interfaces(server, interface_list)
+    window_start[server] = time.monotonic()
+    for interface, probe in probes.items():
+        if probe.state:
+            interfaces[server][interface].state = probe.state
+        else:
+            print(f"Could not verify {interface} on {server}")
+        interfaces[server][interface].speed = probe.speed
+        interfaces[server][interface].raw_light_level = probe.raw_light_level
+        interfaces[server][interface].light_level = probe.light_level
+        interfaces[server][interface].optic = probe.optic
+        interfaces[server][interface].module = probe.module
+        interfaces[server][interface].source_ip = probe.source_ip
+        interfaces[server][interface].before_counters = probe.counters
+        if probe.counters is not None:
+            interfaces[server][interface].before_crc_errors = str(
+                probe.counters.crc_errors
+            )
+            interfaces[server][interface].before_rx_errors = str(
+                probe.counters.rx_errors
+            )
+            interfaces[server][interface].before_tx_errors = str(
+                probe.counters.tx_errors
+            )
 
 
-def check_packet_loss(server: str, interface: str):
-    """Updates Interface Class with the level of packet loss on an interface"""
-    global animate_timer
-    t = interfaces[interface].itype
+async def get_interface_ip(server: str, interface: list) -> str:
+    """returns the ipv4 on a given interface"""
+    cmd = "ip -br a | grep " + interface.lower()
+    result = await run_command(cmd, server)
+    return parse_interface_ip(result, interface)
+
+
+async def get_circuit_peer_ip(ip: str, server: str) -> str:
+    with profiler.span("billboard", "peer_lookup", server=server):
+        return await circuit_peer_ip(ip, server)
+
+
+async def fetch_peer_index(server: str) -> peers.PeerIndex:
+    result = await run_command(f"billboard get peer hostname={server}", server, "local")
+    return peers.PeerIndex.parse(result or "")
+
+
+async def server_peer_index(server: str) -> peers.PeerIndex:
+    """Billboard peers of a server, fetched once per run and shared by every
+    concurrent lookup"""
+    if server in peer_indexes:
+        return peer_indexes[server]
+    fetch = peer_fetches.get(server)
+    if fetch is None or fetch.get_loop() is not asyncio.get_running_loop():
+        fetch = asyncio.ensure_future(fetch_peer_index(server))
+        peer_fetches[server] = fetch
+    # a lookup cancelled by its timeout must not cancel the others' fetch
+    index = await asyncio.shield(fetch)
+    if len(index):
+        peer_indexes[server] = index
+    elif peer_fetches.get(server) is fetch:
+        del peer_fetches[server]
+    return index
+
+
+async def circuit_peer_ip(ip: str, server: str) -> str:
+    peer_ip = peers.point_to_point_peer(ip)
+    if peer_ip:
+        return peer_ip
+    index = await server_peer_index(server)
+    peer_ip = index.peer(ip)
+    if not peer_ip:
+        raise LookupError(f"no Billboard peer inside {ip}")
+    return peer_ip
+
+
+async def ping_target(server: str, interface: str) -> tuple:
+    """Returns the (destination, source) ips to test packet loss on an interface"""
+    t = interfaces[server][interface].itype
     if t == "PNI" or t == "Wave" or t == "IXP":
-        ping_ip = get_circuit_peer_ip(interfaces[interface].ip, server)
+        ping_ip = await get_circuit_peer_ip(interfaces[server][interface].ip, server)
     else:
         ping_ip = "4.2.2.2"
-    source_ip = get_interface_ip(server, interface)
-    cmd = f"sudo ping -f {ping_ip} -c 5000 -I " + source_ip
-    result = send_command_to_server(cmd, server)
-    interfaces[interface].raw_packet_loss = result
+    source_ip = interfaces[server][interface].source_ip
+    if not source_ip:
+        source_ip = await get_interface_ip(server, interface)
+    return ping_ip, source_ip
+
+
+def parse_packet_loss(result: str) -> float:
     match = re.search(r"(\d+).(\d+)%", result)
     if match is None:
         match = re.search(r"(\d+)%", result)
     if match is not None:
-        interfaces[interface].packet_loss = float(match.group(0).replace("%", ""))
-    animate_timer += 1
+        return float(match.group(0).replace("%", ""))
+    return ""
 
 
-def check_incrementing_crc_errors(server: str, interface: str):
-    """Updates Interface Class with the amount of incrementing CRC Errors"""
-    global animate_timer
-    cmd = "sudo ethtool -S " + interface.lower() + " | grep rx_crc_errors"
-    result = send_command_to_server(cmd, server)
-    match = re.search(r"(\d+)", result)
-    if match is not None:
-        interfaces[interface].before_crc_errors = match.group(0)
-    time.sleep(30)
-    result = send_command_to_server(cmd, server)
-    match = re.search(r"(\d+)", result)
+def parse_ping_counts(result: str) -> tuple:
+    """Returns the (transmitted, received) packets from the ping statistics"""
+    match = re.search(r"(\d+) packets transmitted, (\d+) received", result)
     if match is not None:
-        interfaces[interface].after_crc_errors = match.group(0)
-    animate_timer += 1
+        return int(match.group(1)), int(match.group(2))
+    return 0, 0
+
+
+def loss_interval(lost: int, sent: int) -> tuple:
+    """Wilson score interval of the packet loss percentage"""
+    if not sent:
+        return 0.0, 100.0
+    z = LOSS_CONFIDENCE_Z
+    loss = lost / sent
+    denominator = 1 + z * z / sent
+    centre = (loss + z * z / (2 * sent)) / denominator
+    margin = (
+        z * math.sqrt(loss * (1 - loss) / sent + z * z / (4 * sent * sent))
+    ) / denominator
+    return max(0.0, centre - margin) * 100, min(1.0, centre + margin) * 100
+
+
+def loss_decided(lost: int, sent: int, bands: tuple) -> bool:
+    """True once the loss interval sits entirely inside one threshold band"""
+    lower, upper = loss_interval(lost, sent)
+    low_band, high_band = bands
+    return upper < low_band or lower > high_band or low_band < lower < upper < high_band
+
+
+async def adaptive_packet_loss(
+    server: str, ping_ip: str, source_ip: str, bands: tuple
+) -> str:
+    """Flood pings in batches until the loss is confidently below, between or above
+    the (warning, alarm) bands, returns ping statistics for the packets sent"""
+    sent = lost = 0
+    while sent < PING_COUNT:
+        count = min(PING_BATCH, PING_COUNT - sent)
+        cmd = f"sudo ping -f {ping_ip} -c {count} -I {source_ip}"
+        transmitted, received = parse_ping_counts(await run_command(cmd, server))
+        if not transmitted:
+            break
+        sent += transmitted
+        lost += transmitted - received
+        if loss_decided(lost, sent, bands):
+            break
+    if not sent:
+        return ""
+    return (
+        f"{sent} packets transmitted, {sent - lost} received, "
+        f"{round(lost / sent * 100, 3)}% packet loss (adaptive)"
+    )
 
 
-def check_rx_and_tx_incrementing_errors(server: str, interface: str):
-    """Updates Interface Class with amount of RX and TX errors for an interface"""
-    global animate_timer
-    if __name__ == "__main__":
-        print(
-            tcolor("Gathering Incrementing RX and TX Errors...", color="white"),
-            end="\r",
-        )
-    cmd = "sudo ip -s link show " + interface.lower() + r' | grep "RX\|TX" -A 1'
-    result = send_command_to_server(cmd, server)
-    parsed_data = result.split()
-    if len(parsed_data) > 25:
-        interfaces[interface].before_rx_errors = parsed_data[9]
-        interfaces[interface].before_tx_errors = parsed_data[22]
-    time.sleep(30)
-    cmd = "sudo ip -s link show " + interface.lower() + r' | grep "RX\|TX" -A 1'
-    result = send_command_to_server(cmd, server)
-    parsed_data = result.split()
-    if len(parsed_data) > 25:
-        interfaces[interface].after_rx_errors = parsed_data[9]
-        interfaces[interface].after_tx_errors = parsed_data[22]
-    animate_timer += 1
+async def check_packet_loss(server: str, interface: str):
+    """Updates Interface Class with the level of packet loss on an interface"""
+    ping_ip, source_ip = await ping_target(server, interface)
+    if adaptive_loss:
+        profile = interface_profile(server, interface)
+        bands = (profile.loss_warning, profile.loss_alarm)
+        result = await adaptive_packet_loss(server, ping_ip, source_ip, bands)
+    else:
+        cmd = f"sudo ping -f {ping_ip} -c {PING_COUNT} -I " + source_ip
+        result = await run_command(cmd, server)
+    interfaces[server][interface].raw_packet_loss = result
+    packet_loss = parse_packet_loss(result)
+    if packet_loss == "":
+        raise ValueError(f"no packet loss in the ping output {str(result)[-80:]!r}")
+    interfaces[server][interface].packet_loss = packet_loss
+
+
+async def wait_for_counter_window(server: str):
+    """Sleeps until the sampling window opened by collect_interface_data has elapsed"""
+    # a server whose collect failed has no window to wait for
+    elapsed = time.monotonic() - window_start.get(server, 0.0)
+    await asyncio.sleep(max(0.0, sample_window - elapsed))
+
+
+async def check_incrementing_errors(server: str, interface_list: list):
+    """Updates Interface Class with the CRC, RX and TX errors counted over the sampling window"""
+    probes = await probe_interfaces(server, interface_list, COUNTER_PROBES, [])
+    for interface, probe in probes.items():
+        interfaces[server][interface].after_counters = probe.counters
+        if probe.counters is not None:
+            interfaces[server][interface].after_crc_errors = str(
+                probe.counters.crc_errors
+            )
+            interfaces[server][interface].after_rx_errors = str(
+                probe.counters.rx_errors
+            )
+            interfaces[server][interface].after_tx_errors = str(
+                probe.counters.tx_errors
+            )
 
 
 def top_border(interface: str, provider: str):
@@ -243,79 +871,144 @@ def top_border(interface: str, provider: str):
     print(tcolor("\n  -----------------------", color="white"))
 
 
-def print_report(interface: str, mode=""):
+def print_report(server: str, interface: str, mode=""):
     """Takes the Interface Class and calculates if there is a problem with the interface"""
     if mode == "Diagnostic":
-        top_border(interface, interfaces[interface].provider)
-        print(f"  Light_Level: {interfaces[interface].light_level} dBm")
+        top_border(interface, interfaces[server][interface].provider)
+        print(f"  Light_Level: {interfaces[server][interface].light_level} dBm")
+        print_module(interfaces[server][interface].module)
         print(tcolor("  -----------------------", color="white"))
         return
-    RX_Errors = int(interfaces[interface].after_rx_errors) - int(
-        interfaces[interface].before_rx_errors
-    )
-    TX_Errors = int(interfaces[interface].after_tx_errors) - int(
-        interfaces[interface].before_tx_errors
-    )
-    CRC_Errors = int(interfaces[interface].after_crc_errors) - int(
-        interfaces[interface].before_crc_errors
-    )
-    Light_Level = interfaces[interface].light_level
-    Packet_Loss = interfaces[interface].packet_loss
-    top_border(interface, interfaces[interface].provider)
-    print_metric(
-        interface, "RX_Errors:", RX_Errors, validate_metric(float(RX_Errors), 0.0, 1.0)
-    )
-    print_metric(
-        interface, "TX Errors:", TX_Errors, validate_metric(float(TX_Errors), 0.0, 1.0)
+    scores = score_interfaces([(server, interface)])
+    metrics = interface_metrics(server, interface, scores)
+    top_border(interface, interfaces[server][interface].provider)
+    for label, value, color_c in metrics:
+        if label == "Light_Level:" and interfaces[server][interface].speed == "100G":
+            lane_colors = thresholds.colors(scores.lanes[0])
+            print_light_level_array(server, interface, value, lane_colors)
+        else:
+            print_metric(server, interface, label, value, color_c)
+    print(tcolor("  -----------------------", color="white"), end="")
+
+
+def print_module(module: optics.ModuleDom):
+    """Prints the transceiver details and readings of the ethtool -m DOM"""
+    if module is None or not module.identifier:
+        return
+    print(f"  Module: {module.identifier} {module.vendor} {module.part_number}")
+    print(f"  Serial: {module.serial}")
+    if module.temperature is not None and module.voltage is not None:
+        print(f"  Temperature: {module.temperature} C, Voltage: {module.voltage} V")
+    if module.tx_power:
+        print(f"  TX_Power: {' '.join(str(x) for x in module.tx_power)} dBm")
+    if module.bias:
+        print(f"  Bias: {' '.join(str(x) for x in module.bias)} mA")
+    alarms = sorted(set(module.flags) | set(module.breached()))
+    if alarms:
+        print(tcolor(f"  Alarms: {', '.join(alarms)}", color="red"))
+
+
+def interface_profile(server: str, interface: str) -> thresholds.Profile:
+    """Returns the thresholds matching the speed, provider and optic of an interface"""
+    iface = interfaces[server][interface]
+    return threshold_profiles.select(iface.speed, iface.provider, iface.optic)
+
+
+def metric_inputs(server: str, interface: str) -> tuple:
+    """Returns the (rx, tx, crc) error increases, lane light levels and packet loss,
+    raises ValueError or TypeError when a check did not complete"""
+    iface = interfaces[server][interface]
+    # same reset aware increases as the history
+    errors = tuple(
+        error_increase(iface, x) for x in ("rx_errors", "tx_errors", "crc_errors")
     )
-    print_metric(
-        interface,
-        "CRC_Errors:",
-        CRC_Errors,
-        validate_metric(float(CRC_Errors), 0.0, 1.0),
+    if None in errors:
+        raise ValueError("no error counters")
+    lanes = light_values(iface.light_level)
+    if not lanes:
+        raise ValueError("no light level")
+    if iface.loss_error:
+        # scored as unknown, reported on its own
+        return errors, lanes, float("nan")
+    return errors, lanes, float(iface.packet_loss)
+
+
+def score_interfaces(keys: list) -> thresholds.Scores:
+    """Scores the (server, interface) pairs against their threshold profiles at once"""
+    inputs = [metric_inputs(server, interface) for server, interface in keys]
+    return thresholds.score(
+        [x[0] for x in inputs],
+        [x[1] for x in inputs],
+        [x[2] for x in inputs],
+        [interface_profile(server, interface) for server, interface in keys],
     )
-    if interfaces[interface].speed == "100G":
-        print_light_level_array(interface, Light_Level)
-    else:
-        print_metric(
-            interface,
+
+
+def interface_metrics(
+    server: str, interface: str, scores: thresholds.Scores = None, row: int = 0
+) -> list:
+    """Returns (label, value, color) for every metric of an interface and flags problems
+
+    scores: the row of the interface in an already computed score_interfaces
+    """
+    if scores is None:
+        scores, row = score_interfaces([(server, interface)]), 0
+    (RX_Errors, TX_Errors, CRC_Errors), _, _ = metric_inputs(server, interface)
+    rx_color, tx_color, crc_color = thresholds.colors(scores.errors[row])
+    metrics = [
+        ("RX_Errors:", RX_Errors, rx_color),
+        ("TX Errors:", TX_Errors, tx_color),
+        ("CRC_Errors:", CRC_Errors, crc_color),
+        (
             "Light_Level:",
-            Light_Level,
-            validate_metric(float(Light_Level), -9.0, -11.0, "light"),
+            interfaces[server][interface].light_level,
+            thresholds.SEVERITY_COLORS[scores.light[row]],
+        ),
+        (
+            "Packet_Loss:",
+            interfaces[server][interface].packet_loss,
+            thresholds.SEVERITY_COLORS[scores.loss[row]],
+        ),
+    ]
+    if interfaces[server][interface].loss_error:
+        metrics[-1] = (
+            "Packet_Loss:",
+            f"check failed, {interfaces[server][interface].loss_error}",
+            "yellow",
         )
-    print_metric(
-        interface, "Packet_Loss:", Packet_Loss, validate_metric(Packet_Loss, 0.4, 0.1)
-    )
-    print(tcolor("  -----------------------", color="white"), end="")
+    if scores.problem[row]:
+        interfaces[server][interface].problem = True
+    return metrics
 
 
-def print_metric(interface: str, label: str, value: int, color_c: str):
-    if label == "Packet_Loss:":
+def print_metric(server: str, interface: str, label: str, value: int, color_c: str):
+    if label == "Packet_Loss:" and not isinstance(value, str):
         value = str(value) + "%"
     if color_c == "red":
-        interfaces[interface].problem = True
+        interfaces[server][interface].problem = True
     print(tcolor(f"  {label} "), end="")
     print(tcolor(f"{value}", color=color_c))
 
 
-def print_light_level_array(interface: str, light_level: list):
+def print_light_level_array(
+    server: str, interface: str, light_level: list, colors: list
+):
     print("  Light_Level:")
-    for light in light_level:
+    for light, color in zip(light_level, colors):
         value = "     "
-        color = validate_metric(float(light), -9.0, -11.0, "light")
         if "-" not in light:
             value = "      "
-        print_metric(interface, value, light, color)
+        print_metric(server, interface, value, light, color)
 
 
-def no_light_check(light: list, interface: str) -> bool:
+def no_light_check(light: list, server: str, interface: str) -> bool:
     if type(light) == list:
         for level in light:
             if level == -99:
-                interfaces[interface].problem = True
+                interfaces[server][interface].problem = True
                 return True
     elif light == -99:
-        interfaces[interface].problem = True
+        interfaces[server][interface].problem = True
         return True
     return False
 
@@ -369,9 +1062,9 @@ def make_mode_choice() -> str:
     return result
 
 
-def make_diagnostic_choice() -> list:
+def make_diagnostic_choice(server: str) -> list:
     int_list = []
-    for _, value in interfaces.items():
+    for _, value in interfaces[server].items():
         int_string = "{:<10}".format(value.name[:8]) + " "
         int_list.append(int_string)
     cli = Bullet(
@@ -389,9 +1082,9 @@ def make_diagnostic_choice() -> list:
     return [result.split()[0]]
 
 
-def make_interface_choice() -> list:
+def make_interface_choice(server: str) -> list:
     int_list = []
-    for _, value in interfaces.items():
+    for _, value in interfaces[server].items():
         int_string = "{:<10}".format(value.name[:8]) + " "
         int_string += "{:<10}".format(value.provider[:8]) + " "
         int_string += "{:<10}".format(value.itype[:8]) + " "
@@ -416,37 +1109,93 @@ def make_interface_choice() -> list:
     return temp_list
 
 
-def netbox_collect_interfaces(server: str, mode="Normal"):
-    print("  Collecting Netbox Data...", end="\r")
+def netbox_collect_interfaces(server: str, mode="Normal", verbose=True):
+    if verbose:
+        print("  Collecting Netbox Data...", end="\r")
+    recorded = transport.netbox_interfaces(server, mode)
+    if recorded is not None:
+        load_netbox_interfaces(server, recorded)
+        return
     nb = netbox.Netbox()
-    nb_server = nb.get_server(server)
+    with profiler.span("netbox", "get_server", server=server):
+        nb_server = nb.get_server(server)
+    interfaces[server] = {}
     if not nb_server:
-        print("  Sorry, you did not enter a valid server name\n")
-    for nb_iface in nb.get_server_ifaces(nb_server):
-        nb_circuit = nb.get_iface_circuit(nb_iface)
+        print(f"  Sorry, {server} is not a valid server name\n")
+        return
+    with profiler.span("netbox", "prefetch", server=server):
+        nb_ifaces, nb_circuits, circuit_ips = netbox_prefetch(nb_server)
+    for nb_iface in nb_ifaces:
+        nb_circuit = nb_circuits.get(nb_iface.id)
         if nb_circuit is not None and mode == "Normal":
             key = str(nb_iface)[:]
-            interfaces[key] = Interface()
-            interfaces[key].name = key[:]
-            interfaces[key].mac = nb_iface.mac_address[:]
-            interfaces[key].circuit_id = nb_circuit.cid[:]
-            interfaces[key].provider = nb_circuit.provider.name[:]
-            interfaces[key].status = nb_circuit.status.label[:]
-            interfaces[key].itype = convert_circuit_type_names(nb_circuit.type.name[:])
-            interfaces[key].ip = find_circuit_ip(nb, nb_iface)
+            interfaces[server][key] = Interface()
+            interfaces[server][key].name = key[:]
+            interfaces[server][key].server = server
+            interfaces[server][key].mac = nb_iface.mac_address[:]
+            interfaces[server][key].circuit_id = nb_circuit.cid[:]
+            interfaces[server][key].provider = nb_circuit.provider.name[:]
+            interfaces[server][key].status = nb_circuit.status.label[:]
+            interfaces[server][key].itype = convert_circuit_type_names(
+                nb_circuit.type.name[:]
+            )
+            interfaces[server][key].ip = circuit_ips.get(nb_iface.id)
         elif nb_circuit is None and mode == "Diagnostic":
             key = str(nb_iface)[:]
-            interfaces[key] = Interface()
-            interfaces[key].name = key[:]
-            interfaces[key].status = "Unconfigured"
+            interfaces[server][key] = Interface()
+            interfaces[server][key].name = key[:]
+            interfaces[server][key].server = server
+            interfaces[server][key].status = "Unconfigured"
+    transport.save_netbox_interfaces(
+        server,
+        mode,
+        [
+            {name: getattr(x, name) for name in NETBOX_FIELDS}
+            for x in interfaces[server].values()
+        ],
+    )
 
 
-def find_circuit_ip(nb: object, interface: object):
-    nb_ips = nb.get_iface_ips(interface, family=4)
-    for ip in nb_ips:
-        ip_tags = [t.slug for t in ip.tags]
-        if "circuit-interface-ip" in ip_tags:
-            return ip.address[:]
+def load_netbox_interfaces(server: str, rows: list):
+    """Fills the interfaces of a server from recorded Netbox data"""
+    interfaces[server] = {}
+    for row in rows:
+        iface = Interface(**{name: row.get(name, "") for name in NETBOX_FIELDS})
+        iface.server = server
+        interfaces[server][iface.name] = iface
+
+
+def netbox_prefetch(nb_server: object) -> tuple:
+    """Fetches the interfaces, circuits and circuit ips of a server in three queries
+
+    Returns the interfaces plus the circuit and the ipv4 circuit-interface-ip of
+    each interface keyed by interface id, so no lookup is made per interface.
+    """
+    nb_api = pynetbox.api(NETBOX_URL, token=os.environ["NETBOX_TOKEN"])
+    nb_ifaces = list(nb_api.dcim.interfaces.filter(device_id=nb_server.id))
+    circuit_ids = {}
+    for nb_iface in nb_ifaces:
+        if nb_iface.link_peers_type != "circuits.circuittermination":
+            continue
+        for peer in nb_iface.link_peers:
+            circuit_ids[nb_iface.id] = peer.circuit.id
+    nb_circuits = {}
+    if circuit_ids:
+        by_id = {
+            x.id: x
+            for x in nb_api.circuits.circuits.filter(id=list(set(circuit_ids.values())))
+        }
+        nb_circuits = {
+            iface_id: by_id[circuit_id]
+            for iface_id, circuit_id in circuit_ids.items()
+            if circuit_id in by_id
+        }
+    circuit_ips = {}
+    for ip in nb_api.ipam.ip_addresses.filter(
+        device_id=nb_server.id, tag="circuit-interface-ip", family=4
+    ):
+        circuit_ips.setdefault(ip.assigned_object_id, ip.address[:])
+    return nb_ifaces, nb_circuits, circuit_ips
 
 
 def convert_circuit_type_names(circuit: str) -> str:
@@ -461,81 +1210,337 @@ def convert_circuit_type_names(circuit: str) -> str:
     return circuit
 
 
-def animate(count: int, msg: str):
-    global animate_timer
+async def animate(msg: str, done: asyncio.Event):
     msg += "........................"
-    while animate_timer < count:
+    for frame in itertools.cycle("|/-\\"):
         print("{:<44}".format(msg[:44]) + "[", end="")
-        print(tcolor("Loading " + "\b |", color="yellow"), end="")
+        print(tcolor("Loading " + "\b " + frame, color="yellow"), end="")
         print("]", end="\r")
-        time.sleep(0.1)
-        print("{:<44}".format(msg[:44]) + "[", end="")
-        print(tcolor("Loading " + "\b /", color="yellow"), end="")
-        print("]", end="\r")
-        time.sleep(0.1)
-        print("{:<44}".format(msg[:44]) + "[", end="")
-        print(tcolor("Loading " + "\b -", color="yellow"), end="")
-        print("]", end="\r")
-        time.sleep(0.1)
-        print("{:<44}".format(msg[:44]) + "[", end="")
-        print(tcolor("Loading " + "\b \\", color="yellow"), end="")
-        print("]", end="\r")
-        time.sleep(0.1)
-
-
-def loop_threaded_function(server: str, interface: str, func: str, msg=""):
-    global animate_timer
-    threading.Thread(target=func, args=(server, interface)).start()
-    animate(1, msg)
-    animate_timer = 0
+        try:
+            await asyncio.wait_for(done.wait(), 0.1)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+COLLECT_MSG = "  Validating Interfaces and Light Levels"
+
+
+async def run_probe(func: object, server: str, target: object, slots: tuple = ()):
+    """Runs one probe inside the given concurrency slots, cancelling it on timeout"""
+    async with contextlib.AsyncExitStack() as stack:
+        for slot in slots:
+            await stack.enter_async_context(slot)
+        interface = target if isinstance(target, str) else ""
+        tags = profiler.tagged(server=server, interface=interface, check=func.__name__)
+        try:
+            with tags, profiler.span("check", func.__name__):
+                return await asyncio.wait_for(func(server, target), probe_timeout)
+        except asyncio.TimeoutError:
+            print(f"  {func.__name__} timed out after {probe_timeout}s on {target}")
+
+
+async def close_counter_window(server: str, interface_list: list, slots: tuple = ()):
+    """Waits out the sampling window outside of the slots, then reads the counters"""
+    await wait_for_counter_window(server)
+    await run_probe(check_incrementing_errors, server, interface_list, slots)
+
+
+async def run_phase(msg: str, probes: list) -> list:
+    """Runs the probes of a phase concurrently, animating msg until all of them complete"""
+    done = asyncio.Event()
+    spinner = asyncio.create_task(animate(msg, done))
+    results = await asyncio.gather(*probes, return_exceptions=True)
+    done.set()
+    await spinner
     print_complete(msg)
-
-
-def loop_threaded_functions(server: str, interface_list: list, func: str, msg=""):
-    global animate_timer
+    for result in results:
+        if isinstance(result, Exception):
+            print(tcolor(f"  {result!r}", color="red"))
+    return results
+
+
+async def check_interface(server: str, interface: str, slots: tuple = ()) -> str:
+    """Pings one interface, then reads its error counters once the window has closed
+
+    A failed ping doesn't keep the counters from being read, it is kept in loss_error
+    """
+    iface = interfaces[server][interface]
+    try:
+        await run_probe(check_packet_loss, server, interface, slots)
+        if iface.packet_loss == "":
+            # run_probe already reported the timeout
+            iface.loss_error = f"timed out after {probe_timeout}s"
+    except Exception as error:
+        iface.loss_error = repr(error)
+        print(tcolor(f"  {interface}: packet loss check failed {error!r}", color="red"))
+    try:
+        await close_counter_window(server, [interface], slots)
+    except Exception as error:
+        print(tcolor(f"  {interface}: error counters failed {error!r}", color="red"))
+    return interface
+
+
+def recent_problems(server: str) -> set:
+    """Interfaces of a server recorded with a problem within the triage rules' days"""
+    if not history_db:
+        return set()
+    start = time.time() - threshold_profiles.triage.recent_problem_days * 86400
+    try:
+        store = history.History(history_db)
+        problems = store.problem_interfaces(server, start)
+        store.close()
+    except sqlite3.Error:
+        return set()
+    return problems
+
+
+def triage_verdict(server: str, interface: str, problems: set) -> tuple:
+    """Returns (verdict, reason) from the link state, DOM and history of an interface"""
+    iface = interfaces[server][interface]
+    rules = threshold_profiles.triage
+    if iface.state == "DOWN":
+        return "down", "link DOWN"
+    if not iface.state:
+        return "unknown", "link state not collected"
+    if iface.itype in rules.always:
+        return "suspicious", f"{iface.itype} is always checked"
+    if interface in problems:
+        return "suspicious", "problem in the recent history"
+    try:
+        lanes = light_values(iface.light_level)
+    except (TypeError, ValueError):
+        lanes = []
+    if not lanes:
+        return "suspicious", "no light level"
+    severity = thresholds.light_severity(lanes, interface_profile(server, interface))
+    if severity >= rules.light_severity:
+        return "suspicious", f"light level {thresholds.SEVERITY_COLORS[severity]}"
+    module = iface.module
+    if rules.dom_alarms and module is not None and (module.flags or module.breached()):
+        return "suspicious", "module alarms"
+    return "clean", ""
+
+
+def triage_interfaces(server: str, interface_list: list) -> list:
+    """Sets the triage verdict of every interface, returns those needing deep checks"""
+    problems = recent_problems(server)
+    deep = []
     for interface in interface_list:
-        threading.Thread(target=func, args=(server, interface)).start()
-    animate(len(interface_list), msg)
-    animate_timer = 0
-    print_complete(msg)
+        verdict, reason = triage_verdict(server, interface, problems)
+        interfaces[server][interface].triage = verdict
+        interfaces[server][interface].triage_reason = reason
+        if verdict == "down":
+            interfaces[server][interface].problem = True
+        if verdict == "suspicious":
+            deep.append(interface)
+    return deep
+
+
+async def run_checks(server: str, interface_list: list, report: object = None):
+    """Runs every check for the given interfaces of a server
+
+    Only the batch collect is shared; after it every interface runs its own
+    ping -> counters pipeline and is handed to report(server, interface) as soon
+    as it is done, slow interfaces don't hold back the others. In triage mode
+    only the suspicious interfaces get a pipeline.
+    """
+    await run_phase(
+        COLLECT_MSG, [run_probe(collect_interface_data, server, interface_list)]
+    )
+    deep = interface_list
+    if triage_mode:
+        deep = triage_interfaces(server, interface_list)
+    if report is not None:
+        print("\n  Report Printout:")
+        for interface in interface_list:
+            if interface not in deep:
+                report(server, interface)
+    for finished in asyncio.as_completed([check_interface(server, x) for x in deep]):
+        interface = await finished
+        if report is not None:
+            report(server, interface)
+
+
+def print_triage_report(server: str, interface: str):
+    """Report of an interface the triage kept from the deep checks"""
+    iface = interfaces[server][interface]
+    top_border(interface, iface.provider)
+    if iface.triage == "down":
+        print(tcolor(f"  Link_State: {iface.state}", color="red"))
+    elif iface.triage == "unknown":
+        print(tcolor("  Link_State: unknown, incomplete data", color="yellow"))
+    else:
+        print(f"  Light_Level: {iface.light_level}")
+        print(tcolor("  Triage: clean, loss and error checks skipped", color="green"))
+    print(tcolor("  -----------------------", color="white"), end="")
 
 
-def pipeline_mode(server: str, interface: str = ""):
-    print("")
-    netbox_collect_interfaces(server, "Normal")
-    loop_threaded_function(
-        server, interface, is_interface_up, "  Validating Interfaces are UP"
-    )
-    loop_threaded_function(
-        server, interface, check_light_levels, "  Gathering Light Levels"
-    )
-    loop_threaded_function(
-        server, interface, check_packet_loss, "  Gathering Packet Loss"
-    )
-    loop_threaded_function(
-        server,
-        interface,
-        check_incrementing_crc_errors,
-        "  Gathering Incrementing CRC Errors",
-    )
-    loop_threaded_function(
-        server,
-        interface,
-        check_rx_and_tx_incrementing_errors,
-        "  Gathering Incrementing RX and TX Errors",
+def print_streamed_report(server: str, interface: str):
+    """print_report for an interface whose checks just completed"""
+    if interfaces[server][interface].triage in TRIAGE_SKIPPED:
+        print_triage_report(server, interface)
+        sys.stdout.flush()
+        return
+    try:
+        print_report(server, interface)
+    except (TypeError, ValueError):
+        interfaces[server][interface].problem = True
+        top_border(interface, interfaces[server][interface].provider)
+        print(tcolor("  Incomplete data", color="red"))
+        print(tcolor("  -----------------------", color="white"), end="")
+    sys.stdout.flush()
+
+
+def interface_record(server: str, interface: str) -> dict:
+    """Structured result of a checked interface, flags its problems like the report"""
+    iface = interfaces[server][interface]
+    if iface.triage == "down":
+        iface.problem = True
+    elif iface.triage not in TRIAGE_SKIPPED:
+        try:
+            interface_metrics(server, interface)
+        except (TypeError, ValueError):
+            iface.problem = True
+    return {
+        **history_row(server, interface),
+        "optic": iface.optic,
+        "triage": iface.triage,
+        "triage_reason": iface.triage_reason,
+        "loss_error": iface.loss_error,
+        "incomplete": interface_outcome(server, interface) == "incomplete",
+    }
+
+
+def interface_outcome(server: str, interface: str) -> str:
+    """problem, incomplete (its data could not be collected) or clean, for the exit
+    status of a checked interface"""
+    iface = interfaces[server][interface]
+    if iface.triage == "down":
+        return "problem"
+    if iface.triage == "clean":
+        return "clean"
+    if iface.triage == "unknown":
+        return "incomplete"
+    try:
+        metric_inputs(server, interface)
+    except (TypeError, ValueError):
+        return "incomplete"
+    if iface.problem is True:
+        return "problem"
+    if iface.loss_error:
+        return "incomplete"
+    return "clean"
+
+
+def checked_status(pairs: list, failures: int = 0) -> int:
+    """Exit status of the checked (server, interface) pairs"""
+    outcomes = [interface_outcome(server, interface) for server, interface in pairs]
+    return exit_status(
+        outcomes.count("problem"), outcomes.count("incomplete") + failures
     )
-    print("\n  Report Printout:")
-    print_report(interface)
-    print("")
-    if interfaces[interface].problem is True:
-        print(f"  {interface} has an issue")
+
+
+def exit_status(problems: int, failures: int = 0) -> int:
+    if problems:
+        return EXIT_PROBLEMS
+    if failures:
+        return EXIT_INCOMPLETE
+    return EXIT_CLEAN
+
+
+class RecordWriter:
+    """
+    Writes every result as soon as it completes, one JSON object per line
+    (ndjson) or as the elements of a single streamed JSON array (json), and
+    tallies them for the exit status
+    """
+
+    def __init__(self, output_format: str = "ndjson", output: object = None):
+        self.output_format = output_format
+        self.output = output or sys.stdout
+        self.count = 0
+        self.problems = 0
+        self.failures = 0
+
+    def write(self, record: dict):
+        if "error" in record or record.get("incomplete"):
+            self.failures += 1
+        elif record.get("problem"):
+            self.problems += 1
+        text = json.dumps(record)
+        if self.output_format == "json":
+            text = ("[\n" if not self.count else ",\n") + text
+        else:
+            text += "\n"
+        self.count += 1
+        self.output.write(text)
+        self.output.flush()
+
+    def report(self, server: str, interface: str):
+        """report function of run_checks and sweep_server"""
+        self.write(interface_record(server, interface))
+
+    def close(self):
+        if self.output_format == "json":
+            self.output.write("\n]\n" if self.count else "[]\n")
+            self.output.flush()
+
+    @property
+    def status(self) -> int:
+        return exit_status(self.problems, self.failures)
+
+
+@contextlib.contextmanager
+def record_output(default: str = ""):
+    """Yields the RecordWriter of the chosen --format (or default when it is text),
+    None for text output. While writing records every other print goes to stderr"""
+    chosen = default if output_format == "text" else output_format
+    if not chosen or chosen == "text":
+        yield None
+        return
+    writer = RecordWriter(chosen, sys.stdout)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            yield writer
+    finally:
+        writer.close()
+
+
+NO_CIRCUITS = "{server} is unknown to Netbox or has no circuits"
+
+
+def missing_record(server: str, interface: str) -> dict:
+    return {
+        "server": server,
+        "interface": interface,
+        "error": "not a circuit interface in Netbox",
+    }
+
+
+def pipeline_mode(server: str, interface: str = "") -> int:
+    with record_output() as writer:
+        print("")
+        netbox_collect_interfaces(server, "Normal")
+        if interface not in interfaces[server]:
+            print(f"  {interface} is not a circuit interface of {server}")
+            if writer:
+                writer.write(missing_record(server, interface))
+            return EXIT_INCOMPLETE
+        report = writer.report if writer else print_streamed_report
+        asyncio.run(run_checks(server, [interface], report))
+        record_history(server, [interface])
+        print("")
+        if interfaces[server][interface].problem is True:
+            print(f"  {interface} has an issue")
+    return checked_status([(server, interface)])
 
 
 def return_interfaces(server: str, mode="") -> list:
     if mode == "Diagnostic":
-        interface_list = make_diagnostic_choice()
+        interface_list = make_diagnostic_choice(server)
     else:
-        interface_list = make_interface_choice()
+        interface_list = make_interface_choice(server)
     if interface_list is None:
         print("  You must make an interface selection to proceed")
         sys.exit(1)
@@ -545,58 +1550,643 @@ def return_interfaces(server: str, mode="") -> list:
 def diagnostic_mode(server: str, mode: str):
     netbox_collect_interfaces(server, mode)
     interface_list = return_interfaces(server, mode)
-    loop_threaded_functions(
-        server, interface_list, check_light_levels, "  Gathering Light Levels"
+    asyncio.run(
+        run_phase(
+            "  Gathering Light Levels",
+            [run_probe(collect_interface_data, server, interface_list)],
+        )
     )
     for interface in interface_list:
-        print_report(interface, "Diagnostic")
+        print_report(server, interface, "Diagnostic")
     sys.exit(1)
 
 
-def normal_mode(server: str, mode: str):
+def normal_mode(server: str, mode: str) -> int:
     problem_ints = []
     interface_list = []
-    netbox_collect_interfaces(server)
-    if mode == "Entire_Server":
-        for key in interfaces:
-            interface_list.append(key)
-    else:
-        interface_list = return_interfaces(server, mode)
-        if not interface_list:
-            print("You must make an interface selection")
-            sys.exit(1)
-    loop_threaded_functions(
-        server, interface_list, is_interface_up, "  Validating Interfaces are UP"
+    with record_output() as writer:
+        netbox_collect_interfaces(server)
+        if not interfaces[server]:
+            print(f"  {NO_CIRCUITS.format(server=server)}")
+            if writer:
+                writer.write(
+                    {"server": server, "error": NO_CIRCUITS.format(server=server)}
+                )
+            return EXIT_INCOMPLETE
+        if mode == "Entire_Server":
+            for key in interfaces[server]:
+                interface_list.append(key)
+        else:
+            interface_list = return_interfaces(server, mode)
+            if not interface_list:
+                print("You must make an interface selection")
+                sys.exit(1)
+        report = writer.report if writer else print_streamed_report
+        asyncio.run(run_checks(server, interface_list, report))
+        for interface in interface_list:
+            if interfaces[server][interface].problem is True:
+                problem_ints.append(str(interfaces[server][interface].name))
+        record_history(server, interface_list)
+        print("\n")
+        if problem_ints:
+            print(
+                tcolor("  The following interfaces have issues: ", color="white"),
+                end="",
+            )
+            print(tcolor(str([x for x in problem_ints]), color="red"))
+        else:
+            print(tcolor("  There were no issues found", color="green"))
+    return checked_status([(server, x) for x in interface_list])
+
+
+def billboard_hostnames() -> list:
+    """Returns every server that has peers configured in Billboard"""
+    with profiler.span("billboard", "hostnames"):
+        result = send_command_to_server("billboard get peer", "", "local")
+    return billboard.parse_peer_hostnames(result)
+
+
+def select_fleet_servers(sites: list, region: str = "") -> list:
+    """Expands a site and/or region selector into the matching Billboard servers"""
+    return billboard.select_hostnames(billboard_hostnames(), sites, region)
+
+
+def fleet_servers(args: argparse.Namespace) -> list:
+    """Builds the de-duplicated list of servers to sweep from the fleet arguments"""
+    servers = []
+    if args.servers:
+        servers += args.servers.split(",")
+    if args.servers_file:
+        if args.servers_file == "-":
+            servers += sys.stdin.read().split()
+        else:
+            with open(args.servers_file) as servers_file:
+                servers += servers_file.read().split()
+    if args.site or args.region:
+        sites = [x.strip().lower() for x in args.site.split(",") if x.strip()]
+        servers += select_fleet_servers(sites, args.region)
+    return list(dict.fromkeys(x.strip() for x in servers if x.strip()))
+
+
+async def sweep_server(
+    server: str,
+    host_limit: int,
+    global_slots: asyncio.Semaphore,
+    only: list = None,
+    report: object = None,
+):
+    """Runs every normal_mode check against all circuits of a server
+
+    only: check just these circuits, report(server, interface) is called as soon
+    as an interface is done instead of printing the server as complete
+    """
+    await asyncio.to_thread(netbox_collect_interfaces, server, "Normal", False)
+    slots = (asyncio.Semaphore(host_limit), global_slots)
+    if not interfaces[server]:
+        raise LookupError(NO_CIRCUITS.format(server=server))
+    interface_list = [x for x in interfaces[server] if only is None or x in only]
+    if not interface_list:
+        return
+    await run_probe(collect_interface_data, server, interface_list, slots)
+    deep = interface_list
+    if triage_mode:
+        deep = triage_interfaces(server, interface_list)
+    if report is None:
+        await asyncio.gather(*[check_interface(server, x, slots) for x in deep])
+        print_complete(f"  {server}")
+        return
+    for interface in interface_list:
+        if interface not in deep:
+            report(server, interface)
+    for finished in asyncio.as_completed(
+        [check_interface(server, x, slots) for x in deep]
+    ):
+        report(server, await finished)
+
+
+async def sweep_fleet(
+    servers: list, host_limit: int, global_limit: int, report: object = None
+) -> dict:
+    """Sweeps every server at once, returns the servers whose sweep failed
+
+    report(server, interface) is called for every interface as soon as it is done
+    """
+    global_slots = asyncio.Semaphore(global_limit)
+    results = await asyncio.gather(
+        *[sweep_server(x, host_limit, global_slots, report=report) for x in servers],
+        return_exceptions=True,
     )
-    loop_threaded_functions(
-        server, interface_list, check_light_levels, "  Gathering Light Levels"
+    return {
+        server: result
+        for server, result in zip(servers, results)
+        if isinstance(result, Exception)
+    }
+
+
+def score_fleet(servers: list, failed: dict) -> tuple:
+    """Scores every complete interface of the sweep in one pass, returns the scored
+    (server, interface) pairs and their thresholds.Scores"""
+    scored = []
+    for server in servers:
+        if server in failed:
+            continue
+        for interface, iface in interfaces.get(server, {}).items():
+            if iface.triage in TRIAGE_SKIPPED:
+                continue
+            try:
+                metric_inputs(server, interface)
+            except (TypeError, ValueError):
+                continue
+            scored.append((server, interface))
+    return scored, score_interfaces(scored)
+
+
+def print_fleet_report(servers: list, failed: dict) -> int:
+    """Prints one merged report with the problem interfaces of every server,
+    returns the number of problem interfaces"""
+    problem_count = 0
+    scored, scores = score_fleet(servers, failed)
+    rows = {key: row for row, key in enumerate(scored)}
+    print("\n  Fleet Report:")
+    print(tcolor("  -----------------------", color="white"))
+    for server in servers:
+        if server in failed:
+            continue
+        for interface, iface in interfaces.get(server, {}).items():
+            if iface.triage == "clean":
+                continue
+            try:
+                row = rows[(server, interface)]
+                metrics = interface_metrics(server, interface, scores, row)
+                details = [
+                    f"{label} {value}"
+                    for label, value, color_c in metrics
+                    if color_c == "red"
+                ]
+            except (KeyError, TypeError, ValueError):
+                iface.problem = True
+                details = ["Incomplete data"]
+            if iface.triage == "down":
+                details = ["Link DOWN"]
+            elif iface.triage == "unknown":
+                iface.problem = True
+                details = ["Incomplete data, link state not collected"]
+            if iface.problem is not True:
+                continue
+            problem_count += 1
+            print(f"  {server:<22}{interface:<10}", end="")
+            print(tcolor(f"({iface.provider[:10]}) ", color="white"), end="")
+            print(tcolor(", ".join(details), color="red"))
+    for server, error in failed.items():
+        print(f"  {server:<22}", end="")
+        print(tcolor(f"Sweep failed: {error}", color="red"))
+    print(tcolor("  -----------------------", color="white"))
+    if problem_count or failed:
+        print(
+            tcolor(
+                f"  {problem_count} interfaces with issues, {len(failed)} servers failed",
+                color="red",
+            )
+        )
+    else:
+        print(
+            tcolor(
+                f"  There were no issues found on {len(servers)} servers", color="green"
+            )
+        )
+    return problem_count
+
+
+def fleet_mode(servers: list, host_limit: int = 8, global_limit: int = 64) -> int:
+    """Runs the normal_mode checks against many servers in parallel"""
+    if not servers:
+        print("  No servers matched the fleet selection")
+        sys.exit(1)
+    with record_output() as writer:
+        print(f"  Sweeping {len(servers)} servers...")
+        report = writer.report if writer else None
+        failed = asyncio.run(sweep_fleet(servers, host_limit, global_limit, report))
+        if writer:
+            for server, error in failed.items():
+                writer.write({"server": server, "error": repr(error)})
+        else:
+            print_fleet_report(servers, failed)
+        for server in servers:
+            if server not in failed:
+                record_history(server, list(interfaces.get(server, {})))
+    if writer:
+        return writer.status
+    checked = [
+        (server, interface)
+        for server in servers
+        if server not in failed
+        for interface in interfaces.get(server, {})
+    ]
+    return checked_status(checked, len(failed))
+
+
+def batch_targets(lines: list) -> tuple:
+    """Parses batch input lines into ({server: [interfaces]}, [circuit ids])
+
+    A line is either "server interface" (or server,interface) or a circuit ID,
+    blank lines and # comments are skipped.
+    """
+    targets, circuit_ids = {}, []
+    for line in lines:
+        words = line.partition("#")[0].replace(",", " ").split()
+        if len(words) == 1:
+            circuit_ids.append(words[0])
+        elif len(words) >= 2:
+            targets.setdefault(words[0], []).append(words[1])
+    return targets, list(dict.fromkeys(circuit_ids))
+
+
+def netbox_circuit_interfaces(circuit_ids: list) -> dict:
+    """Returns {circuit id: (server, interface)} of the circuits terminating on a
+    server interface, in two queries"""
+    nb_api = pynetbox.api(NETBOX_URL, token=os.environ["NETBOX_TOKEN"])
+    circuits = {x.id: x.cid for x in nb_api.circuits.circuits.filter(cid=circuit_ids)}
+    if not circuits:
+        return {}
+    found = {}
+    for termination in nb_api.circuits.circuit_terminations.filter(
+        circuit_id=list(circuits)
+    ):
+        for peer in termination.link_peers or []:
+            device = getattr(peer, "device", None)
+            if device is not None:
+                found[circuits[termination.circuit.id]] = (device.name, peer.name)
+    return found
+
+
+def history_circuit_interfaces(circuit_ids: list) -> dict:
+    """Returns {circuit id: (server, interface)} of the last check of each circuit"""
+    if not history_db:
+        return {}
+    found = {}
+    try:
+        store = history.History(history_db)
+        for circuit_id in circuit_ids:
+            rows = store.query(circuit_id=circuit_id)
+            if rows:
+                found[circuit_id] = (rows[-1]["server"], rows[-1]["interface"])
+        store.close()
+    except sqlite3.Error:
+        pass
+    return found
+
+
+def resolve_circuits(circuit_ids: list) -> dict:
+    """Finds the server and interface of every circuit, from Netbox and then from
+    the history of past checks (the only source while replaying)"""
+    found = {}
+    if circuit_ids and not isinstance(transport, replay.Replayer):
+        with profiler.span("netbox", "circuits"):
+            found = netbox_circuit_interfaces(circuit_ids)
+    missing = [x for x in circuit_ids if x not in found]
+    if missing:
+        found.update(history_circuit_interfaces(missing))
+    return found
+
+
+async def batch_server(
+    server: str,
+    requested: list,
+    host_limit: int,
+    global_slots: asyncio.Semaphore,
+    writer: RecordWriter,
+):
+    """Checks the requested interfaces of a server, writing each result when done"""
+    try:
+        await sweep_server(server, host_limit, global_slots, requested, writer.report)
+    except Exception as error:
+        for interface in requested:
+            writer.write(
+                {"server": server, "interface": interface, "error": repr(error)}
+            )
+        return
+    for interface in requested:
+        if interface not in interfaces.get(server, {}):
+            writer.write(missing_record(server, interface))
+
+
+async def run_batch(
+    targets: dict, host_limit: int, global_limit: int, writer: RecordWriter
+):
+    global_slots = asyncio.Semaphore(global_limit)
+    await asyncio.gather(
+        *[
+            batch_server(server, requested, host_limit, global_slots, writer)
+            for server, requested in targets.items()
+        ]
     )
-    loop_threaded_functions(
-        server, interface_list, check_packet_loss, "  Gathering Packet Loss"
+
+
+def batch_mode(source: str, host_limit: int = 8, global_limit: int = 64) -> int:
+    """Checks the (server, interface) pairs and circuit IDs read from a file or
+    stdin ('-'), every server once for all its circuits, as NDJSON (or --format)
+    on stdout"""
+    if source == "-":
+        lines = sys.stdin.read().split("\n")
+    else:
+        with open(source) as batch_file:
+            lines = batch_file.read().split("\n")
+    targets, circuit_ids = batch_targets(lines)
+    with record_output("ndjson") as writer:
+        circuits = resolve_circuits(circuit_ids)
+        for circuit_id in circuit_ids:
+            if circuit_id not in circuits:
+                writer.write({"circuit_id": circuit_id, "error": "circuit not found"})
+                continue
+            server, interface = circuits[circuit_id]
+            targets.setdefault(server, [])
+            if interface not in targets[server]:
+                targets[server].append(interface)
+        asyncio.run(run_batch(targets, host_limit, global_limit, writer))
+        for server, requested in targets.items():
+            record_history(
+                server, [x for x in requested if x in interfaces.get(server, {})]
+            )
+    return writer.status
+
+
+@dataclass
+class WatchSample:
+    timestamp: float = 0.0
+    interval: float = 0.0
+    rx_errors: int = 0
+    tx_errors: int = 0
+    crc_errors: int = 0
+    packet_loss: float = ""
+    light_min: float = ""
+    light_max: float = ""
+
+
+def light_values(light_level: object) -> list:
+    """Returns the light level of every lane as floats"""
+    if isinstance(light_level, list):
+        return [float(x) for x in light_level]
+    if light_level == "":
+        return []
+    return [float(light_level)]
+
+
+async def watch_ping(server: str, target: tuple, count: int) -> float:
+    ping_ip, source_ip = target
+    if not ping_ip or not source_ip:
+        return ""
+    cmd = f"sudo ping -f {ping_ip} -c {count} -I {source_ip}"
+    return parse_packet_loss(await run_command(cmd, server))
+
+
+async def watch_poll(
+    server: str,
+    interface_list: list,
+    targets: dict,
+    ping_count: int,
+    previous: dict,
+    history: dict,
+):
+    """Takes one sample of counters, light levels and packet loss for every interface"""
+    probes, *losses = await asyncio.gather(
+        probe_interfaces(server, interface_list, BATCH_PROBES, []),
+        *[watch_ping(server, targets[x], ping_count) for x in interface_list],
     )
-    loop_threaded_functions(
-        server,
-        interface_list,
-        check_incrementing_crc_errors,
-        "  Gathering Incrementing CRC Errors",
+    for interface, packet_loss in zip(interface_list, losses):
+        probe = probes[interface]
+        interfaces[server][interface].state = probe.state
+        sample = WatchSample(timestamp=time.time(), packet_loss=packet_loss)
+        lights = light_values(probe.light_level)
+        if lights:
+            sample.light_min = min(lights)
+            sample.light_max = max(lights)
+        before = previous.get(interface)
+        if probe.counters is not None and before is not None:
+            delta = probe.counters.delta(before)
+            sample.interval = probe.counters.timestamp - before.timestamp
+            sample.rx_errors = delta["rx_errors"]
+            sample.tx_errors = delta["tx_errors"]
+            sample.crc_errors = netstats.counter_increase(
+                probe.counters.crc_errors, before.crc_errors
+            )
+        if probe.counters is not None:
+            previous[interface] = probe.counters
+        history[interface].append(sample)
+
+
+def loss_trend(samples: list) -> str:
+    """Compares the average packet loss of the newer half of the window with the older half"""
+    losses = [x.packet_loss for x in samples if x.packet_loss != ""]
+    if len(losses) < 2:
+        return " "
+    half = len(losses) // 2
+    change = sum(losses[half:]) / (len(losses) - half) - sum(losses[:half]) / half
+    if change > 0.05:
+        return "↑"
+    elif change < -0.05:
+        return "↓"
+    return "→"
+
+
+def print_watch_row(server: str, interface: str, samples: deque):
+    last = samples[-1]
+    profile = interface_profile(server, interface)
+    window = sum(x.interval for x in samples)
+    print(f"  {interface:<10}", end="")
+    print(f"{interfaces[server][interface].provider[:10]:<11}", end="")
+    print(f"{interfaces[server][interface].state:<6}", end="")
+    for attr in ("rx_errors", "tx_errors", "crc_errors"):
+        live = getattr(last, attr) / last.interval if last.interval else 0.0
+        average = sum(getattr(x, attr) for x in samples) / window if window else 0.0
+        # the thresholds count errors, not errors per second
+        color_c = validate_metric(
+            float(getattr(last, attr)), profile.errors_warning, profile.errors_alarm
+        )
+        print(tcolor(f"{live:>8.2f} ({average:.2f})".ljust(18), color=color_c), end="")
+    losses = [x.packet_loss for x in samples if x.packet_loss != ""]
+    if losses:
+        loss = f"{losses[-1]}% ({sum(losses) / len(losses):.2f}% {loss_trend(samples)})"
+        color_c = validate_metric(losses[-1], profile.loss_warning, profile.loss_alarm)
+    else:
+        loss, color_c = "n/a", "white"
+    print(tcolor(loss.ljust(20), color=color_c), end="")
+    minimums = [x.light_min for x in samples if x.light_min != ""]
+    maximums = [x.light_max for x in samples if x.light_max != ""]
+    if minimums:
+        light = f"{last.light_min} [{min(minimums)} / {max(maximums)}]"
+        color_c = validate_metric(
+            min(minimums), profile.light_warning, profile.light_alarm, "light"
+        )
+    else:
+        light, color_c = "n/a", "white"
+    print(tcolor(light, color=color_c))
+
+
+def print_watch_report(server: str, interface_list: list, history: dict, interval: int):
+    print("\033[2J\033[H", end="")
+    samples = max(len(x) for x in history.values())
+    print(
+        tcolor(
+            f"  {server}: {samples} samples every {interval}s "
+            f"({time.strftime('%H:%M:%S')}, Ctrl-C to stop)\n",
+            color="white",
+        )
     )
-    loop_threaded_functions(
-        server,
-        interface_list,
-        check_rx_and_tx_incrementing_errors,
-        "  Gathering Incrementing RX and TX Errors",
+    print(
+        f"  {'Interface':<10}{'Provider':<11}{'State':<6}"
+        f"{'RX err/s (avg)':<18}{'TX err/s (avg)':<18}{'CRC err/s (avg)':<18}"
+        f"{'Loss (avg trend)':<20}Light dBm [min / max]"
     )
-    print("\n  Report Printout:")
     for interface in interface_list:
-        print_report(interface)
-        if interfaces[interface].problem is True:
-            problem_ints.append(str(interfaces[interface].name))
-    print("\n")
-    if problem_ints:
-        print(tcolor("  The following interfaces have issues: ", color="white"), end="")
-        print(tcolor(str([x for x in problem_ints]), color="red"))
+        if history[interface]:
+            print_watch_row(server, interface, history[interface])
+
+
+def watch_mode(
+    server: str,
+    interface: str = "",
+    interval: int = 10,
+    samples: int = 30,
+    ping_count: int = 100,
+):
+    """Polls counters, light levels and packet loss until interrupted
+
+    Every interface keeps at most the last samples readings, so memory use is
+    the same however long the watch runs.
+    """
+    netbox_collect_interfaces(server)
+    interface_list = [interface] if interface else list(interfaces[server])
+    try:
+        asyncio.run(watch_loop(server, interface_list, interval, samples, ping_count))
+    except KeyboardInterrupt:
+        print("")
+
+
+async def watch_loop(
+    server: str, interface_list: list, interval: int, samples: int, ping_count: int
+):
+    await collect_interface_data(server, interface_list)
+    targets = {}
+    for interface in interface_list:
+        try:
+            targets[interface] = await ping_target(server, interface)
+        except Exception as error:
+            # watched without packet loss, see watch_ping
+            print(tcolor(f"  {interface}: no ping target {error!r}", color="red"))
+            targets[interface] = ("", "")
+    history = {x: deque(maxlen=samples) for x in interface_list}
+    previous = {}
+    while True:
+        started = time.monotonic()
+        await watch_poll(server, interface_list, targets, ping_count, previous, history)
+        print_watch_report(server, interface_list, history, interval)
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def error_increase(iface: Interface, counter: str) -> int:
+    """Increase of rx_errors, tx_errors or crc_errors over the sampling window"""
+    before, after = iface.before_counters, iface.after_counters
+    if before is None or after is None:
+        return None
+    return netstats.counter_increase(getattr(after, counter), getattr(before, counter))
+
+
+def history_row(server: str, interface: str) -> dict:
+    """Returns the history record of a checked interface"""
+    iface = interfaces[server][interface]
+    try:
+        lanes = [x for x in light_values(iface.light_level) if x > -99]
+    except (TypeError, ValueError):
+        lanes = []
+    packet_loss = iface.packet_loss
+    return {
+        "server": server,
+        "interface": interface,
+        "circuit_id": iface.circuit_id,
+        "provider": iface.provider,
+        "itype": iface.itype,
+        "state": iface.state,
+        "speed": iface.speed,
+        "light_min": min(lanes) if lanes else None,
+        "light_max": max(lanes) if lanes else None,
+        "lanes": lanes,
+        "packet_loss": packet_loss if isinstance(packet_loss, float) else None,
+        "rx_errors": error_increase(iface, "rx_errors"),
+        "tx_errors": error_increase(iface, "tx_errors"),
+        "crc_errors": error_increase(iface, "crc_errors"),
+        "problem": bool(iface.problem),
+    }
+
+
+def record_history(server: str, interface_list: list):
+    """Stores the results of the checked interfaces in the history database"""
+    if not history_db:
+        return
+    try:
+        store = history.History(history_db)
+        store.record([history_row(server, x) for x in interface_list])
+        store.close()
+    except sqlite3.Error as error:
+        print(f"  Could not record the results in {history_db}: {error}")
+
+
+def trend_mode(server: str = "", interface: str = "", days: float = 30):
+    """Prints the light level trend of every recorded interface, flags degrading optics"""
+    try:
+        store = history.History(history_db or HISTORY_DB)
+        trends = store.light_trends(days, server, interface)
+        store.close()
+    except sqlite3.Error as error:
+        print(f"  Could not read {history_db}: {error}")
+        sys.exit(1)
+    if not trends:
+        print(f"  No light levels recorded in the last {days:g} days")
+        return
+    print(f"\n  Light Level Trend (last {days:g} days):")
+    print(tcolor("  -----------------------", color="white"))
+    degrading = 0
+    for trend in trends:
+        color_c = "red" if trend.degrading else "white"
+        line = (
+            f"  {trend.server:<22}{trend.interface:<10}{trend.circuit_id:<16}"
+            f"{trend.first_light:>7.2f} -> {trend.last_light:>6.2f} dBm"
+            f"{trend.slope:>+8.3f} dB/day ({trend.samples} samples)"
+        )
+        if trend.degrading:
+            degrading += 1
+            line += f" alarm in {trend.days_to_alarm:.0f} days"
+        print(tcolor(line, color=color_c))
+    print(tcolor("  -----------------------", color="white"))
+    if degrading:
+        print(tcolor(f"  {degrading} optics are degrading", color="red"))
     else:
-        print(tcolor("  There were no issues found", color="green"))
+        print(tcolor("  No degrading optics found", color="green"))
+
+
+def print_profile():
+    """Prints the p50/p95 of every command type, lookup and check of the run"""
+    print("\n  Profile:")
+    print(tcolor("  -----------------------", color="white"))
+    print(
+        f"  {'':<10}{'name':<26}{'count':>6}{'p50':>9}{'p95':>9}{'max':>9}{'total':>9}"
+    )
+    for kind, name, count, p50, p95, slowest, total in profiler.summary():
+        print(
+            f"  {kind:<10}{name[:25]:<26}{count:>6}"
+            f"{p50:>8.3f}s{p95:>8.3f}s{slowest:>8.3f}s{total:>8.2f}s"
+        )
+    print(tcolor("  -----------------------", color="white"))
+
+
+def finish_profile(show: bool, trace: str, records: bool = False):
+    """records: stdout carries --format records, the profile goes to stderr"""
+    stream = sys.stderr if records else sys.stdout
+    with contextlib.redirect_stdout(stream):
+        if show:
+            print_profile()
+        if trace:
+            profiler.dump(trace)
+            print(f"  Timing spans written to {trace}")
 
 
 def main():
@@ -611,11 +2201,53 @@ def main():
 
 if __name__ == "__main__":
     args = arg_parse()
-    if args.server and args.interface:
-        pipeline_mode(args.server, args.interface)
+    sample_window = args.window
+    probe_timeout = args.timeout
+    adaptive_loss = args.adaptive_loss
+    agent_collection = args.agent
+    triage_mode = args.triage
+    if args.no_record or (args.replay and not args.db):
+        history_db = ""
+    else:
+        history_db = args.db or HISTORY_DB
+    output_format = args.format
+    if args.profile or args.trace:
+        profiler.enabled = True
+        records = output_format != "text" or bool(args.batch)
+        atexit.register(finish_profile, args.profile, args.trace, records)
+    if args.replay:
+        transport = replay.Replayer(
+            args.replay, args.replay_latency, args.replay_jitter
+        )
+    elif args.record:
+        transport = replay.Recorder(transport, args.record)
+        atexit.register(transport.save)
+    if args.thresholds:
+        try:
+            threshold_profiles = thresholds.Profiles.load(args.thresholds)
+        except (OSError, ValueError) as error:
+            print(f"  Could not load the thresholds in {args.thresholds}: {error}")
+            sys.exit(1)
+    if args.trend:
+        trend_mode(args.server, args.interface, args.days)
+    elif args.batch:
+        sys.exit(batch_mode(args.batch, args.host_concurrency, args.global_concurrency))
+    elif args.servers or args.servers_file or args.site or args.region:
+        print()
+        sys.exit(
+            fleet_mode(
+                fleet_servers(args), args.host_concurrency, args.global_concurrency
+            )
+        )
+    elif args.server and args.watch:
+        watch_mode(
+            args.server, args.interface, args.interval, args.history, args.watch_pings
+        )
+    elif args.server and args.interface:
+        sys.exit(pipeline_mode(args.server, args.interface))
     elif args.server:
         print()
-        normal_mode(args.server, "Entire_Server")
+        sys.exit(normal_mode(args.server, "Entire_Server"))
     else:
         print_splash_screen()
         main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""Benchmark interface_checker modes against a simulated fleet"""
+
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+import interface_checker as ic
+from lib import netstats, profiling
+
+# functions timed as the phases of a run and their label
+PHASES = {
+    "netbox_collect_interfaces": "netbox",
+    "collect_interface_data": "collect",
+    "check_packet_loss": "loss",
+    "check_incrementing_errors": "errors",
+}
+MODES = ("normal", "pipeline", "diagnostic", "fleet")
+
+
+class SimulatedTransport:
+    """
+    Fake SSH transport answering every interface_checker command with synthetic
+    output after latency (+ up to jitter) seconds
+
+    interfaces: circuits per server, counters: extra ethtool -S counters per
+    interface to make the output bigger
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, interfaces=4, counters=50):
+        self.latency = latency
+        self.jitter = jitter
+        self.interfaces = interfaces
+        self.counters = counters
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def interface_names(self) -> list:
+        return [f"mcx{x // 2 + 1}p{x % 2 + 1}" for x in range(self.interfaces)]
+
+    def link(self, name: str) -> str:
+        return (
+            f"4: {name}: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc mq "
+            "state UP mode DEFAULT group default qlen 1000"
+        )
+
+    def speed(self, name: str) -> str:
+        return "10000" if name.endswith("p1") else "100000"
+
+    def module(self, name: str) -> str:
+        if name.endswith("p1"):
+            return (
+                "\tIdentifier                                : 0x03 (SFP)\n"
+                "\tVendor name                               : FINISAR CORP.\n"
+                "\tLaser output power                        : 0.5000 mW / -3.01 dBm\n"
+                "\tReceiver signal average optical power     : 0.4797 mW / -3.19 dBm"
+            )
+        lines = ["\tIdentifier                                : 0x11 (QSFP28)"]
+        for lane in range(1, 5):
+            lines.append(
+                f"\tRcvr signal avg optical power(Channel {lane})  : 0.6000 mW / -2.22 dBm"
+            )
+        return "\n".join(lines)
+
+    def sysfs(self, name: str) -> str:
+        return "\n".join(
+            f"/sys/class/net/{name}/statistics/{x}:{random.randint(0, 3)}"
+            for x in netstats.SYSFS_COUNTERS
+        )
+
+    def stats(self, name: str) -> str:
+        lines = ["NIC statistics:", f"     rx_crc_errors_phy: {random.randint(0, 1)}"]
+        lines += [
+            f"     rx_queue_{x}_packets: {x * 1000}" for x in range(self.counters)
+        ]
+        return "\n".join(lines)
+
+    def addresses(self) -> str:
+        return "\n".join(
+            f"{name:<17}UP             10.0.{x}.0/31"
+            for x, name in enumerate(self.interface_names())
+        )
+
+    def batch(self, cmd: str) -> str:
+        names = cmd[len("for i in ") : cmd.index("; do")].split()
+        probes = [x.split('"')[0] for x in cmd.split('echo "### $i ')[1:]]
+        output = []
+        for name in names:
+            for probe in probes:
+                output.append(f"### {name} {probe}")
+                if probe == "clock":
+                    output.append(str(time.time()))
+                elif probe == "link":
+                    output.append(self.link(name))
+                else:
+                    output.append(getattr(self, probe)(name))
+        if "### all addresses" in cmd:
+            output += ["### all addresses", self.addresses()]
+        return "\n".join(output)
+
+    def answer(self, cmd: str) -> str:
+        if cmd.startswith("for i in "):
+            return self.batch(cmd)
+        if "ping" in cmd:
+            count = int(cmd.split("-c ")[1].split()[0])
+            return (
+                f"{count} packets transmitted, {count} received, 0% packet loss, "
+                "time 1ms"
+            )
+        if cmd.startswith("ip -br a"):
+            return self.addresses()
+        if cmd.startswith("billboard get peer"):
+            return "Hostname Name AS IP Type State"
+        return ""
+
+    def agent(self, cmd: str) -> list:
+        probes = cmd.split()[3].split(",")
+        records = []
+        for name in cmd.split()[4:]:
+            record = {"interface": name}
+            if "link" in probes:
+                record["state"] = "UP"
+            if "speed" in probes:
+                record["speed"] = int(self.speed(name))
+            if "module" in probes:
+                record["module"] = self.module(name)
+            if "counters" in probes:
+                record["timestamp"] = time.time()
+                record["sysfs"] = netstats.parse_sysfs_statistics(self.sysfs(name))
+                record["ethtool"] = netstats.parse_ethtool_statistics(self.stats(name))
+            if "addresses" in probes:
+                record["source_ip"] = ic.parse_interface_ip(self.addresses(), name)
+            records.append(json.dumps(record))
+        return records
+
+    def send(self, cmd: str, server="", itype="server") -> str:
+        time.sleep(self.delay())
+        return self.answer(cmd)
+
+    async def run(self, cmd: str, server="", itype="server") -> str:
+        await asyncio.sleep(self.delay())
+        return self.answer(cmd)
+
+    async def stream(self, cmd: str, server="", itype="server", stdin=b""):
+        await asyncio.sleep(self.delay())
+        for line in self.agent(cmd):
+            yield line
+
+    def netbox_interfaces(self, server: str, mode: str) -> list:
+        time.sleep(self.delay())
+        if mode == "Diagnostic":
+            return [{"name": "mcx9p1", "status": "Unconfigured"}]
+        return [
+            {
+                "name": name,
+                "circuit_id": f"{server}-{name}",
+                "provider": "Simulated",
+                "status": "Active",
+                "itype": "PNI" if x % 2 else "Transit",
+                "ip": f"10.0.{x}.0/31",
+            }
+            for x, name in enumerate(self.interface_names())
+        ]
+
+    def save_netbox_interfaces(self, server: str, mode: str, rows: list):
+        pass
+
+
+class PhaseTimer:
+    """
+    Wall clock span of every phase on every server, from its first call starting
+    to its last ending
+    """
+
+    def __init__(self):
+        self.spans = {}
+
+    def reset(self):
+        self.spans = {}
+
+    def add(self, phase: str, server: str, start: float, end: float):
+        first, last = self.spans.get((phase, server), (start, end))
+        self.spans[(phase, server)] = (min(first, start), max(last, end))
+
+    def durations(self) -> dict:
+        """Average seconds per server of every phase"""
+        totals, servers = {}, {}
+        for (phase, _), (start, end) in self.spans.items():
+            totals[phase] = totals.get(phase, 0.0) + end - start
+            servers[phase] = servers.get(phase, 0) + 1
+        return {phase: totals[phase] / servers[phase] for phase in totals}
+
+    def wrap(self, phase: str):
+        func = getattr(ic, phase)
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.add(phase, args[0], start, time.perf_counter())
+
+        else:
+
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(phase, args[0], start, time.perf_counter())
+
+        setattr(ic, phase, timed)
+
+
+class ThreadSampler:
+    """
+    Samples the number of live threads until stopped, keeping the peak
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.done.is_set():
+            self.peak = max(self.peak, threading.active_count())
+            self.done.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        # the sampler itself is not part of the measured run
+        self.peak -= 1
+
+
+def run_mode(mode: str, servers: list):
+    if mode == "fleet":
+        ic.fleet_mode(servers)
+        return
+    for server in servers:
+        if mode == "normal":
+            ic.normal_mode(server, "Entire_Server")
+        elif mode == "pipeline":
+            ic.pipeline_mode(server, ic.transport.interface_names()[0])
+        elif mode == "diagnostic":
+            with contextlib.suppress(SystemExit):
+                ic.diagnostic_mode(server, "Diagnostic")
+
+
+def benchmark(mode: str, servers: list, timer: PhaseTimer) -> dict:
+    """Runs a mode against the servers, returns its measurements"""
+    # every run starts without the state of the previous one
+    ic.interfaces.clear()
+    ic.window_start.clear()
+    ic.peer_indexes.clear()
+    ic.peer_fetches.clear()
+    ic.profiler = profiling.Profiler(ic.profiler.enabled)
+    timer.reset()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with ThreadSampler() as threads, contextlib.redirect_stdout(io.StringIO()):
+        run_mode(mode, servers)
+    wall = time.perf_counter() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "mode": mode,
+        "servers": len(servers),
+        "wall": wall,
+        "phases": timer.durations(),
+        "threads": threads.peak,
+        "memory": peak_memory,
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def print_result(result: dict):
+    phases = " ".join(
+        f"{PHASES[phase]}={seconds:.2f}s" for phase, seconds in result["phases"].items()
+    )
+    print(
+        f"  {result['mode']:<11}{result['servers']:>5} servers "
+        f"{result['wall']:>8.2f}s  threads={result['threads']:<4}"
+        f"memory={result['memory'] / 2**20:>7.1f}MiB "
+        f"rss={result['max_rss'] / 2**20:>7.1f}MiB  {phases}"
+    )
+
+
+def arg_parse() -> object:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks interface_checker against a simulated fleet"
+    )
+    parser.add_argument(
+        "-m",
+        "--modes",
+        default=",".join(MODES),
+        help=f"Comma separated modes to run (default: {','.join(MODES)})",
+    )
+    parser.add_argument(
+        "-n",
+        "--servers",
+        default="1,10,100",
+        help="Comma separated fleet sizes (default: 1,10,100)",
+    )
+    parser.add_argument(
+        "--interfaces", type=int, default=4, help="Circuits per server (default: 4)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Seconds every simulated command takes (default: 0.05)",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Up to this many extra seconds per command (default: 0)",
+    )
+    parser.add_argument(
+        "--counters",
+        type=int,
+        default=50,
+        help="Extra ethtool -S counters per interface, sets the output size (default: 50)",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=0,
+        help="Seconds of the error counter sampling window (default: 0)",
+    )
+    parser.add_argument(
+        "--adaptive-loss", action="store_true", help="Use the adaptive loss test"
+    )
+    parser.add_argument(
+        "--agent", action="store_true", help="Collect through the remote agent"
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def main():
+    args = arg_parse()
+    ic.transport = SimulatedTransport(
+        args.latency, args.jitter, args.interfaces, args.counters
+    )
+    ic.sample_window = args.window
+    ic.adaptive_loss = args.adaptive_loss
+    ic.agent_collection = args.agent
+    ic.history_db = ""
+    # diagnostic_mode asks which interfaces to check
+    ic.return_interfaces = lambda server, mode="": list(ic.interfaces[server])
+    timer = PhaseTimer()
+    for phase in PHASES:
+        timer.wrap(phase)
+    results = []
+    for mode in args.modes.split(","):
+        for size in [int(x) for x in args.servers.split(",")]:
+            servers = [f"sim-{x:04d}-data01" for x in range(size)]
+            result = benchmark(mode, servers, timer)
+            results.append(result)
+            if not args.json:
+                print_result(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
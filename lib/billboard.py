@@ -3,7 +3,10 @@ import typing
 from dataclasses import dataclass
 from subprocess import Popen
 
-from .general import shell_cmd, ansible_is_alpha
+import airports
+import regions
+
+from .general import get_server_site, shell_cmd, ansible_is_alpha
 from .credentials import sops_envfile
 
 bb_path_parsed_type = list[dict[str, typing.Union[str, set[str]]]]
@@ -91,6 +94,45 @@ def parse_peer_data(data: str) -> list[bb_dataclass]:
     return billboard_data
 
 
+def parse_peer_hostnames(data: str) -> list[str]:
+    """
+    Every hostname of the billboard get peer output, once and in order
+    """
+    hostnames = []
+    # don't use the header
+    for line in data.split("\n")[1:]:
+        fields = line.split()
+        if fields and fields[0] not in hostnames:
+            hostnames.append(fields[0])
+    return hostnames
+
+
+def select_hostnames(
+    hostnames: list[str], sites: list[str], region: str = ""
+) -> list[str]:
+    """
+    The hostnames of the given sites (lower case, every site when empty) that lie in the
+    region when one is given
+    """
+    if region:
+        airport_lookup = airports.Airports()
+        region_lookup = regions.Regions()
+    selected = []
+    for hostname in hostnames:
+        _, site_name = get_server_site(hostname)
+        if sites and site_name.lower() not in sites:
+            continue
+        if region:
+            airport = airport_lookup.lookup(site_name[0:3])
+            if airport is None:
+                continue
+            host_region = region_lookup.lookup(airport.iso_country)
+            if host_region is None or host_region.region.lower() != region.lower():
+                continue
+        selected.append(hostname)
+    return selected
+
+
 def get_parsed_peer_data(server: str) -> list[bb_dataclass]:
     peer_data = get_peer_data(server=server)
     return parse_peer_data(data=peer_data)
@@ -0,0 +1,115 @@
+"""
+Remote collection agent for interface_checker
+
+The source of this module is piped over SSH into "python3 -" on the server, so it
+must only use the standard library. Every interface given on the command line is
+written to stdout as one JSON record per line as soon as it has been read:
+
+    python3 - link,speed,module,counters,addresses mcx1p1 mcx1p10
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+SYSFS_NET = "/sys/class/net"
+
+
+def read_sysfs(interface, name):
+    try:
+        with open(os.path.join(SYSFS_NET, interface, name)) as sysfs:
+            return sysfs.read().strip()
+    except OSError:
+        return ""
+
+
+def run(args):
+    try:
+        return subprocess.run(
+            args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        ).stdout.decode("utf-8", "replace")
+    except OSError:
+        return ""
+
+
+def link_state(interface):
+    """UP or DOWN like the state of ip link show, from the carrier of the interface"""
+    operstate = read_sysfs(interface, "operstate")
+    if not operstate:
+        return ""
+    return "UP" if operstate == "up" else "DOWN"
+
+
+def link_speed(interface):
+    """Speed in Mb/s, -1 when the link is down or the driver doesn't report it"""
+    speed = read_sysfs(interface, "speed")
+    return int(speed) if speed.lstrip("-").isdigit() else -1
+
+
+def sysfs_statistics(interface):
+    directory = os.path.join(SYSFS_NET, interface, "statistics")
+    statistics = {}
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return statistics
+    for name in names:
+        value = read_sysfs(interface, os.path.join("statistics", name))
+        if value.isdigit():
+            statistics[name] = int(value)
+    return statistics
+
+
+def ethtool_statistics(interface):
+    statistics = {}
+    for line in run(["ethtool", "-S", interface]).split("\n"):
+        name, _, value = line.partition(":")
+        if value.strip().isdigit():
+            statistics[name.strip()] = int(value)
+    return statistics
+
+
+def interface_addresses():
+    """First IPv4 address of every interface from ip -j addr"""
+    try:
+        links = json.loads(run(["ip", "-j", "-4", "addr"]) or "[]")
+    except ValueError:
+        return {}
+    addresses = {}
+    for link in links:
+        for address in link.get("addr_info", []):
+            if address.get("family") == "inet":
+                addresses.setdefault(link.get("ifname"), address.get("local"))
+    return addresses
+
+
+def collect(interface, probes, addresses):
+    record = {"interface": interface}
+    if "link" in probes:
+        record["state"] = link_state(interface)
+    if "speed" in probes:
+        record["speed"] = link_speed(interface)
+    if "module" in probes:
+        # parsed locally by lib.optics, ethtool -m is read once
+        record["module"] = run(["ethtool", "-m", interface])
+    if "counters" in probes:
+        record["timestamp"] = time.time()
+        record["sysfs"] = sysfs_statistics(interface)
+        record["ethtool"] = ethtool_statistics(interface)
+    if "addresses" in probes:
+        record["source_ip"] = addresses.get(interface, "")
+    return record
+
+
+def main():
+    probes = set(sys.argv[1].split(","))
+    addresses = interface_addresses() if "addresses" in probes else {}
+    for interface in sys.argv[2:]:
+        sys.stdout.write(json.dumps(collect(interface, probes, addresses)) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
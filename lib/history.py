@@ -0,0 +1,210 @@
+"""
+Local time-series store of interface_checker results
+
+Every checked interface becomes one row of a SQLite table indexed by
+server/interface and circuit id over time, so range queries and the light level
+trend stay fast with millions of rows.
+"""
+
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+
+# dBm where print_report turns the light level red
+LIGHT_ALARM = -11.0
+# dB per day of light loss before an optic counts as degrading
+DEGRADING_SLOPE = -0.05
+SECONDS_PER_DAY = 86400
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    timestamp REAL NOT NULL,
+    server TEXT NOT NULL,
+    interface TEXT NOT NULL,
+    circuit_id TEXT,
+    provider TEXT,
+    itype TEXT,
+    state TEXT,
+    speed TEXT,
+    light_min REAL,
+    light_max REAL,
+    lanes TEXT,
+    packet_loss REAL,
+    rx_errors INTEGER,
+    tx_errors INTEGER,
+    crc_errors INTEGER,
+    problem INTEGER
+);
+CREATE INDEX IF NOT EXISTS results_interface
+    ON results (server, interface, timestamp);
+CREATE INDEX IF NOT EXISTS results_circuit ON results (circuit_id, timestamp);
+CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp);
+"""
+
+COLUMNS = (
+    "timestamp",
+    "server",
+    "interface",
+    "circuit_id",
+    "provider",
+    "itype",
+    "state",
+    "speed",
+    "light_min",
+    "light_max",
+    "lanes",
+    "packet_loss",
+    "rx_errors",
+    "tx_errors",
+    "crc_errors",
+    "problem",
+)
+
+
+@dataclass
+class LightTrend:
+    server: str = ""
+    interface: str = ""
+    circuit_id: str = ""
+    samples: int = 0
+    first_light: float = 0.0
+    last_light: float = 0.0
+    # least squares slope of the weakest lane in dB per day
+    slope: float = 0.0
+
+    @property
+    def degrading(self) -> bool:
+        return self.samples >= 3 and self.slope <= DEGRADING_SLOPE
+
+    @property
+    def days_to_alarm(self) -> float:
+        """Days until the light level reaches LIGHT_ALARM at the current slope"""
+        if self.slope >= 0:
+            return float("inf")
+        return max(0.0, (self.last_light - LIGHT_ALARM) / -self.slope)
+
+
+class History:
+    """
+    SQLite backed history of every interface result
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, rows: list):
+        """Stores result rows (dicts keyed by COLUMNS) in a single transaction"""
+        values = []
+        for row in rows:
+            row = dict(row)
+            row.setdefault("timestamp", time.time())
+            if isinstance(row.get("lanes"), list):
+                row["lanes"] = json.dumps(row["lanes"])
+            values.append(tuple(row.get(x) for x in COLUMNS))
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO results ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in COLUMNS)})",
+                values,
+            )
+
+    def query(
+        self,
+        start: float = 0.0,
+        end: float = None,
+        server: str = "",
+        interface: str = "",
+        circuit_id: str = "",
+    ) -> list:
+        """Results between start and end (epoch seconds), oldest first"""
+        clauses = ["timestamp >= ?", "timestamp <= ?"]
+        params = [start, time.time() if end is None else end]
+        if circuit_id:
+            clauses.append("circuit_id = ?")
+            params.append(circuit_id)
+        if server:
+            clauses.append("server = ?")
+            params.append(server)
+        if interface:
+            clauses.append("interface = ?")
+            params.append(interface)
+        cursor = self.connection.execute(
+            f"SELECT * FROM results WHERE {' AND '.join(clauses)} ORDER BY timestamp",
+            params,
+        )
+        return [dict(x) for x in cursor]
+
+    def problem_interfaces(self, server: str, start: float) -> set:
+        """Interfaces of a server with a problem recorded since start"""
+        cursor = self.connection.execute(
+            "SELECT DISTINCT interface FROM results "
+            "WHERE server = ? AND timestamp >= ? AND problem = 1",
+            (server, start),
+        )
+        return {x["interface"] for x in cursor}
+
+    def light_trends(self, days: float = 30, server: str = "", interface: str = ""):
+        """Light level trend of every interface over the last days, worst first
+
+        The regression is aggregated inside SQLite so only one row per interface
+        leaves the database.
+        """
+        start = time.time() - days * SECONDS_PER_DAY
+        clauses = ["timestamp >= ?", "light_min IS NOT NULL", "light_min > -99"]
+        params = [start]
+        if server:
+            clauses.append("server = ?")
+            params.append(server)
+        if interface:
+            clauses.append("interface = ?")
+            params.append(interface)
+        cursor = self.connection.execute(
+            f"""
+            SELECT server, interface, MAX(circuit_id) AS circuit_id,
+                COUNT(*) AS n,
+                SUM(x) AS sx, SUM(light_min) AS sy,
+                SUM(x * x) AS sxx, SUM(x * light_min) AS sxy,
+                MIN(timestamp) AS first_seen, MAX(timestamp) AS last_seen
+            FROM (
+                SELECT *, (timestamp - ?) / {SECONDS_PER_DAY} AS x FROM results
+                WHERE {' AND '.join(clauses)}
+            )
+            GROUP BY server, interface
+            """,
+            [start] + params,
+        )
+        trends = []
+        for row in cursor.fetchall():
+            trend = LightTrend(
+                server=row["server"],
+                interface=row["interface"],
+                circuit_id=row["circuit_id"] or "",
+                samples=row["n"],
+            )
+            denominator = row["n"] * row["sxx"] - row["sx"] ** 2
+            if denominator > 0:
+                trend.slope = (
+                    row["n"] * row["sxy"] - row["sx"] * row["sy"]
+                ) / denominator
+            trend.first_light = self.light_at(
+                row["server"], row["interface"], row["first_seen"]
+            )
+            trend.last_light = self.light_at(
+                row["server"], row["interface"], row["last_seen"]
+            )
+            trends.append(trend)
+        return sorted(trends, key=lambda x: x.slope)
+
+    def light_at(self, server: str, interface: str, timestamp: float) -> float:
+        row = self.connection.execute(
+            "SELECT light_min FROM results "
+            "WHERE server = ? AND interface = ? AND timestamp = ?",
+            (server, interface, timestamp),
+        ).fetchone()
+        return row["light_min"] if row is not None else 0.0
@@ -0,0 +1,157 @@
+"""
+Typed snapshots of the kernel and driver counters of a network interface
+"""
+
+import re
+from dataclasses import dataclass, field
+
+# counters exposed by the kernel under /sys/class/net/<iface>/statistics/
+SYSFS_COUNTERS = (
+    "rx_bytes",
+    "rx_packets",
+    "rx_errors",
+    "rx_dropped",
+    "rx_crc_errors",
+    "rx_frame_errors",
+    "rx_fifo_errors",
+    "rx_length_errors",
+    "rx_missed_errors",
+    "rx_over_errors",
+    "rx_nohandler",
+    "multicast",
+    "collisions",
+    "tx_bytes",
+    "tx_packets",
+    "tx_errors",
+    "tx_dropped",
+    "tx_aborted_errors",
+    "tx_carrier_errors",
+    "tx_fifo_errors",
+    "tx_heartbeat_errors",
+    "tx_window_errors",
+)
+
+
+def counter_increase(after: int, before: int) -> int:
+    """Increase of a counter, a lower value than before means the driver reset it"""
+    if after >= before:
+        return after - before
+    return after
+
+
+@dataclass
+class CounterSnapshot:
+    interface: str = ""
+    timestamp: float = 0.0
+    rx_bytes: int = 0
+    rx_packets: int = 0
+    rx_errors: int = 0
+    rx_dropped: int = 0
+    rx_crc_errors: int = 0
+    rx_frame_errors: int = 0
+    rx_fifo_errors: int = 0
+    rx_length_errors: int = 0
+    rx_missed_errors: int = 0
+    rx_over_errors: int = 0
+    rx_nohandler: int = 0
+    multicast: int = 0
+    collisions: int = 0
+    tx_bytes: int = 0
+    tx_packets: int = 0
+    tx_errors: int = 0
+    tx_dropped: int = 0
+    tx_aborted_errors: int = 0
+    tx_carrier_errors: int = 0
+    tx_fifo_errors: int = 0
+    tx_heartbeat_errors: int = 0
+    tx_window_errors: int = 0
+    # driver specific counters from ethtool -S
+    ethtool: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def crc_errors(self) -> int:
+        """The driver CRC counter (e.g. rx_crc_errors_phy), the kernel one otherwise"""
+        for name, value in self.ethtool.items():
+            if name.startswith("rx_crc_errors"):
+                return value
+        return self.rx_crc_errors
+
+    def counters(self) -> dict[str, int]:
+        """Every counter of the snapshot, the sysfs value wins when both have a name"""
+        values = dict(self.ethtool)
+        values.update({name: getattr(self, name) for name in SYSFS_COUNTERS})
+        return values
+
+    def delta(self, before: "CounterSnapshot") -> dict[str, int]:
+        """Increase of every counter since the before snapshot"""
+        previous = before.counters()
+        return {
+            name: counter_increase(value, previous[name])
+            for name, value in self.counters().items()
+            if name in previous
+        }
+
+    def rate(self, before: "CounterSnapshot") -> dict[str, float]:
+        """Per second increase of every counter since the before snapshot"""
+        elapsed = self.timestamp - before.timestamp
+        if elapsed <= 0:
+            return {name: 0.0 for name in self.delta(before)}
+        return {name: value / elapsed for name, value in self.delta(before).items()}
+
+
+def parse_sysfs_statistics(data: str) -> dict[str, int]:
+    """
+    data: (output of grep . /sys/class/net/<iface>/statistics/*)
+    /sys/class/net/mcx1p1/statistics/rx_bytes:123456789
+    /sys/class/net/mcx1p1/statistics/rx_crc_errors:0
+    """
+    statistics = {}
+    for line in data.split("\n"):
+        path, _, value = line.strip().rpartition(":")
+        name = path.rsplit("/", 1)[-1]
+        if name in SYSFS_COUNTERS and value.isdigit():
+            statistics[name] = int(value)
+    return statistics
+
+
+def parse_ethtool_statistics(data: str) -> dict[str, int]:
+    """
+    data: (output of ethtool -S <iface>)
+    NIC statistics:
+         rx_packets: 98765
+         rx_crc_errors_phy: 0
+    """
+    return {
+        name: int(value)
+        for name, value in re.findall(r"^\s*([^:\s]+):\s*(\d+)\s*$", data, re.MULTILINE)
+    }
+
+
+def counter_snapshot(
+    interface: str, timestamp: float, sysfs: dict, ethtool: dict
+) -> CounterSnapshot:
+    """Builds a CounterSnapshot from already parsed counters, None without kernel counters"""
+    statistics = {
+        name: value for name, value in sysfs.items() if name in SYSFS_COUNTERS
+    }
+    if not statistics:
+        return None
+    return CounterSnapshot(
+        interface=interface, timestamp=timestamp, ethtool=dict(ethtool), **statistics
+    )
+
+
+def parse_counter_snapshot(
+    interface: str, timestamp: str, sysfs: str, ethtool: str
+) -> CounterSnapshot:
+    """Builds a CounterSnapshot, returns None when the kernel counters could not be read"""
+    try:
+        clock = float(timestamp.strip())
+    except ValueError:
+        clock = 0.0
+    return counter_snapshot(
+        interface,
+        clock,
+        parse_sysfs_statistics(sysfs),
+        parse_ethtool_statistics(ethtool),
+    )
@@ -0,0 +1,146 @@
+"""
+Digital optical monitoring (DOM) of the transceiver of an interface
+
+parse_module_dom turns the output of a single ethtool -m call into a compact
+ModuleDom with the per lane power and bias, temperature, voltage, vendor data
+and the alarm/warning thresholds of the module. SFP (SFF-8472) and QSFP
+(SFF-8636) layouts are both understood.
+"""
+
+from dataclasses import asdict, dataclass, field
+
+# ethtool prints -inf dBm when a lane receives nothing at all
+NO_LIGHT = -99.0
+
+RX_POWER = ("Receiver signal average optical power", "Rcvr signal avg optical power")
+TX_POWER = ("Laser output power", "Transmit avg optical power")
+BIAS = ("Laser bias current", "Laser tx bias current")
+# threshold names of ethtool and their short name in ModuleDom.thresholds
+THRESHOLD_NAMES = (
+    ("Laser bias current", "bias"),
+    ("Laser output power", "tx_power"),
+    ("Laser tx power", "tx_power"),
+    ("Laser rx power", "rx_power"),
+    ("Module temperature", "temperature"),
+    ("Module voltage", "voltage"),
+)
+
+
+@dataclass
+class ModuleDom:
+    identifier: str = ""
+    vendor: str = ""
+    part_number: str = ""
+    serial: str = ""
+    # degrees C and V
+    temperature: float = None
+    voltage: float = None
+    # one value per lane, dBm for the power and mA for the bias
+    rx_power: list[float] = field(default_factory=list)
+    tx_power: list[float] = field(default_factory=list)
+    bias: list[float] = field(default_factory=list)
+    # e.g. {"rx_power_low_alarm": -13.9, "temperature_high_warning": 70.0}
+    thresholds: dict[str, float] = field(default_factory=dict)
+    # alarm and warning flags reported as On, e.g. ["rx_power_low_alarm"]
+    flags: list[str] = field(default_factory=list)
+
+    def record(self) -> dict:
+        """The DOM as a plain dict, without the empty values"""
+        return {name: value for name, value in asdict(self).items() if value}
+
+    def breached(self) -> list:
+        """Names of the thresholds crossed by the current readings"""
+        readings = {
+            "rx_power": self.rx_power,
+            "tx_power": self.tx_power,
+            "bias": self.bias,
+            "temperature": [] if self.temperature is None else [self.temperature],
+            "voltage": [] if self.voltage is None else [self.voltage],
+        }
+        crossed = []
+        for name, limit in self.thresholds.items():
+            metric, _, kind = name.partition("_high_")
+            if not kind:
+                metric, _, kind = name.partition("_low_")
+                values = [x for x in readings.get(metric, []) if x < limit]
+            else:
+                values = [x for x in readings.get(metric, []) if x > limit]
+            if values:
+                crossed.append(name)
+        return crossed
+
+
+def parse_reading(value: str, unit: str = "") -> float:
+    """Returns the dBm of a power reading (0.4797 mW / -3.19 dBm), else the first number"""
+    if "dBm" in value:
+        value = value.rpartition("/")[2]
+    elif unit and unit in value:
+        value = value.partition(unit)[0]
+    number = value.split()[0] if value.split() else ""
+    try:
+        reading = float(number)
+    except ValueError:
+        return None
+    if reading == float("-inf"):
+        return NO_LIGHT
+    return reading
+
+
+def threshold_name(name: str) -> str:
+    """Laser rx power low warning threshold -> rx_power_low_warning"""
+    words = name.replace(" threshold", "")
+    for prefix, short in THRESHOLD_NAMES:
+        if words.startswith(prefix):
+            return short + "_" + words[len(prefix) :].strip().replace(" ", "_")
+    return ""
+
+
+def add_lane(lanes: list, reading: float):
+    if reading is not None:
+        lanes.append(reading)
+
+
+def parse_module_dom(data: str) -> ModuleDom:
+    """
+    data: (output of ethtool -m <iface>)
+    Identifier                                : 0x11 (QSFP28)
+    Vendor name                               : FINISAR CORP
+    Rcvr signal avg optical power(Channel 1)  : 0.6000 mW / -2.22 dBm
+    Laser rx power low alarm threshold        : 0.0407 mW / -13.90 dBm
+    """
+    dom = ModuleDom()
+    for line in data.split("\n"):
+        name, _, value = line.partition(":")
+        name, value = name.strip(), value.strip()
+        # QSFP flags carry the lane, e.g. Laser rx power low alarm   (Chan 1)
+        flag = name.partition("(Chan")[0].strip()
+        if not value:
+            continue
+        if name.endswith("threshold"):
+            short = threshold_name(name)
+            reading = parse_reading(value)
+            if short and reading is not None:
+                dom.thresholds[short] = reading
+        elif flag.endswith(("alarm", "warning")):
+            short = threshold_name(flag)
+            if short and value == "On" and short not in dom.flags:
+                dom.flags.append(short)
+        elif name == "Identifier":
+            dom.identifier = value.partition("(")[2].partition(")")[0]
+        elif name == "Vendor name":
+            dom.vendor = value
+        elif name == "Vendor PN":
+            dom.part_number = value
+        elif name == "Vendor SN":
+            dom.serial = value
+        elif name == "Module temperature":
+            dom.temperature = parse_reading(value)
+        elif name == "Module voltage":
+            dom.voltage = parse_reading(value)
+        elif name.startswith(RX_POWER):
+            add_lane(dom.rx_power, parse_reading(value))
+        elif name.startswith(TX_POWER):
+            add_lane(dom.tx_power, parse_reading(value))
+        elif name.startswith(BIAS):
+            add_lane(dom.bias, parse_reading(value, "mA"))
+    return dom
@@ -0,0 +1,87 @@
+"""
+Billboard peers of a server indexed by address
+
+A PeerIndex is built once per server from the output of billboard get peer. The
+peer addresses of each IP version are kept as sorted integers, so the peer on the
+far side of a circuit subnet is found by range containment with a binary search
+instead of scanning the output. Lookups are cached per subnet.
+"""
+
+import bisect
+
+from netaddr import AddrFormatError, IPAddress, IPNetwork
+
+# column of the peer address in billboard get peer
+PEER_IP_COLUMN = 3
+
+
+def parse_peer_ips(data: str) -> list:
+    """
+    data: (output of billboard get peer hostname=<server>)
+    Hostname          Name    AS    IP                   Type        State    ...
+    sub-mxp01-data01  cogent  174   2001:978:2:2a::61:1  IPT_GLOBAL  ENABLED  ...
+    sub-mxp01-data01  cogent  174   149.14.134.49        IPT_GLOBAL  ENABLED  ...
+    """
+    peer_ips = []
+    for line in data.split("\n")[1:]:
+        words = line.split()
+        if len(words) <= PEER_IP_COLUMN:
+            continue
+        try:
+            peer_ips.append(IPAddress(words[PEER_IP_COLUMN]))
+        except (AddrFormatError, ValueError):
+            continue
+    return peer_ips
+
+
+def point_to_point_peer(subnet: str) -> str:
+    """The other address of a /31 or /127, else an empty string"""
+    network = IPNetwork(subnet)
+    if network.size != 2:
+        return ""
+    for address in network:
+        if address != network.ip:
+            return str(address)
+    return ""
+
+
+class PeerIndex:
+    """
+    Peer addresses of one server, by IP version
+    """
+
+    def __init__(self, peer_ips: list):
+        self.addresses = {4: [], 6: []}
+        for peer_ip in peer_ips:
+            self.addresses[peer_ip.version].append(int(peer_ip))
+        for values in self.addresses.values():
+            values.sort()
+        # subnet -> peer address already looked up
+        self.subnets = {}
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self.addresses.values())
+
+    @classmethod
+    def parse(cls, data: str) -> "PeerIndex":
+        return cls(parse_peer_ips(data))
+
+    def peer(self, subnet: str) -> str:
+        """Peer address inside the subnet of an interface address (10.0.0.1/24),
+        other than the interface itself, or an empty string"""
+        network = IPNetwork(subnet)
+        if network.cidr not in self.subnets:
+            self.subnets[network.cidr] = self.lookup(network)
+        peer_ip = self.subnets[network.cidr]
+        if peer_ip == str(network.ip):
+            return self.lookup(network)
+        return peer_ip
+
+    def lookup(self, network: IPNetwork) -> str:
+        values = self.addresses[network.version]
+        start = bisect.bisect_left(values, network.first)
+        end = bisect.bisect_right(values, network.last)
+        for value in values[start:end]:
+            if value != int(network.ip):
+                return str(IPAddress(value, network.version))
+        return ""
@@ -0,0 +1,69 @@
+"""
+Longest prefix match of addresses against a set of IPv4 and IPv6 prefixes
+
+A PrefixIndex is a binary radix trie per IP version. Adding a prefix walks one
+node per prefix bit and a lookup walks at most one node per address bit, so an
+address finds the value of its most specific prefix in O(prefix length) however
+many prefixes are indexed.
+"""
+
+from netaddr import IPAddress, IPNetwork
+
+# node layout: [zero child, one child, has value, value]
+ZERO, ONE, SET, VALUE = range(4)
+
+
+def new_node() -> list:
+    return [None, None, False, None]
+
+
+class PrefixIndex:
+    """
+    Maps prefixes (10.0.0.0/24, 2001:db8::/64, or an interface address such as
+    10.0.0.1/24) to values, looked up by the most specific prefix containing an
+    address
+    """
+
+    def __init__(self, prefixes: dict = None):
+        self.roots = {4: new_node(), 6: new_node()}
+        self.widths = {4: 32, 6: 128}
+        self.size = 0
+        for prefix, value in (prefixes or {}).items():
+            self.add(prefix, value)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, prefix: str, value: object):
+        """Indexes the network of prefix, a later value of the same network wins"""
+        network = IPNetwork(prefix)
+        width = self.widths[network.version]
+        first = network.first
+        node = self.roots[network.version]
+        for bit in range(width - 1, width - 1 - network.prefixlen, -1):
+            branch = (first >> bit) & 1
+            if node[branch] is None:
+                node[branch] = new_node()
+            node = node[branch]
+        if not node[SET]:
+            self.size += 1
+        node[SET], node[VALUE] = True, value
+
+    def lookup(self, address: str, default: object = None) -> object:
+        """Value of the longest prefix containing address, else default"""
+        address = IPAddress(address)
+        width = self.widths[address.version]
+        value = int(address)
+        node = self.roots[address.version]
+        found = node[VALUE] if node[SET] else default
+        for bit in range(width - 1, -1, -1):
+            node = node[(value >> bit) & 1]
+            if node is None:
+                break
+            if node[SET]:
+                found = node[VALUE]
+        return found
+
+    def __contains__(self, address: str) -> bool:
+        missing = object()
+        return self.lookup(address, missing) is not missing
@@ -0,0 +1,142 @@
+"""
+Timing spans of interface_checker commands, lookups and checks
+
+Spans are tagged with the server, interface and check they ran for. The tags
+live in context variables, so every asyncio task started inside a tagged block
+inherits them. A disabled Profiler records nothing.
+"""
+
+import contextlib
+import contextvars
+import json
+import math
+import time
+from dataclasses import asdict, dataclass
+
+TAGS = contextvars.ContextVar("profiling_tags", default={})
+
+
+@dataclass
+class Span:
+    # command, netbox, billboard or check
+    kind: str
+    # command type, lookup or check name
+    name: str
+    start: float
+    end: float
+    server: str = ""
+    interface: str = ""
+    check: str = ""
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+def percentile(durations: list, fraction: float) -> float:
+    """Nearest-rank percentile of sorted durations"""
+    rank = max(1, math.ceil(fraction * len(durations)))
+    return durations[rank - 1]
+
+
+def command_type(cmd: str) -> str:
+    """Groups the commands sent to servers by what they do"""
+    if cmd.startswith("for i in "):
+        return "batch probe"
+    if cmd.startswith("sudo python3 -"):
+        return "agent"
+    words = [x for x in cmd.split() if x != "sudo"]
+    if words[:1] == ["ping"]:
+        return "ping"
+    if words[:1] == ["billboard"]:
+        return "billboard " + " ".join(words[1:3])
+    return words[0] if words else ""
+
+
+class Profiler:
+    """
+    Collects Spans while enabled
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.spans = []
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def tagged(self, **tags):
+        """Tags every span started inside the block (server, interface, check)"""
+        token = TAGS.set({**TAGS.get(), **{k: v for k, v in tags.items() if v}})
+        try:
+            yield
+        finally:
+            TAGS.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, kind: str, name: str, **tags):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            tags = {**TAGS.get(), **{k: v for k, v in tags.items() if v}}
+            self.spans.append(Span(kind, name, start, time.perf_counter(), **tags))
+
+    def summary(self) -> list:
+        """(kind, name, count, p50, p95, max, total) of every span type, slowest first"""
+        durations = {}
+        for span in self.spans:
+            durations.setdefault((span.kind, span.name), []).append(span.duration)
+        rows = []
+        for (kind, name), values in durations.items():
+            values.sort()
+            rows.append(
+                (
+                    kind,
+                    name,
+                    len(values),
+                    percentile(values, 0.5),
+                    percentile(values, 0.95),
+                    values[-1],
+                    sum(values),
+                )
+            )
+        return sorted(rows, key=lambda x: x[6], reverse=True)
+
+    def dump(self, path: str):
+        """Writes the spans in the Chrome trace event format (chrome://tracing, Perfetto),
+        one track per server"""
+        tracks = {}
+        events = []
+        for span in self.spans:
+            track = tracks.setdefault(span.server or "local", len(tracks) + 1)
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.kind,
+                    "ph": "X",
+                    "ts": (span.start - self.origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": 1,
+                    "tid": track,
+                    "args": {
+                        k: v
+                        for k, v in asdict(span).items()
+                        if k not in ("start", "end")
+                    },
+                }
+            )
+        for server, track in tracks.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": track,
+                    "args": {"name": server},
+                }
+            )
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events}, trace_file)
@@ -0,0 +1,151 @@
+"""
+Offline record and replay of the commands interface_checker sends to servers
+
+A Recorder wraps the live transport and keeps every command output (and the
+Netbox interfaces of every server) in one JSON fixture per server. A Replayer
+answers the same commands from those fixtures, optionally after a configurable
+latency, so the checks can run without SSH or Netbox. Servers without a fixture
+are answered from default.json when it exists, which lets one recording stand in
+for a whole fleet.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+
+DEFAULT_FIXTURE = "default"
+LOCAL_FIXTURE = "local"
+
+
+def fixture_name(server: str, itype: str) -> str:
+    return server if itype == "server" and server else LOCAL_FIXTURE
+
+
+def empty_fixture(name: str) -> dict:
+    return {"server": name, "commands": {}, "netbox": {}}
+
+
+class Recorder:
+    """
+    Transport that passes commands to another transport and records their output
+    """
+
+    def __init__(self, transport: object, directory: str):
+        self.transport = transport
+        self.directory = directory
+        self.fixtures = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, cmd: str, output: str):
+        with self.lock:
+            fixture = self.fixtures.setdefault(name, empty_fixture(name))
+            fixture["commands"].setdefault(cmd, []).append(output)
+
+    def send(self, cmd: str, server="", itype="server") -> str:
+        output = self.transport.send(cmd, server, itype)
+        self.add(fixture_name(server, itype), cmd, output)
+        return output
+
+    async def run(self, cmd: str, server="", itype="server") -> str:
+        output = await self.transport.run(cmd, server, itype)
+        self.add(fixture_name(server, itype), cmd, output)
+        return output
+
+    async def stream(self, cmd: str, server="", itype="server", stdin=b""):
+        lines = []
+        try:
+            async for line in self.transport.stream(cmd, server, itype, stdin):
+                lines.append(line)
+                yield line
+        finally:
+            self.add(fixture_name(server, itype), cmd, "\n".join(lines))
+
+    def netbox_interfaces(self, server: str, mode: str) -> list:
+        rows = self.transport.netbox_interfaces(server, mode)
+        if rows is not None:
+            self.save_netbox_interfaces(server, mode, rows)
+        return rows
+
+    def save_netbox_interfaces(self, server: str, mode: str, rows: list):
+        with self.lock:
+            fixture = self.fixtures.setdefault(server, empty_fixture(server))
+            fixture["netbox"][mode] = rows
+
+    def save(self):
+        """Writes every fixture recorded so far"""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            for name, fixture in self.fixtures.items():
+                path = os.path.join(self.directory, f"{name}.json")
+                with open(path, "w") as fixture_file:
+                    json.dump(fixture, fixture_file, indent=1)
+
+
+class Replayer:
+    """
+    Transport answering commands from recorded fixtures
+
+    latency: seconds every command takes, jitter: up to that many seconds more
+    """
+
+    def __init__(self, directory: str, latency: float = 0.0, jitter: float = 0.0):
+        self.directory = directory
+        self.latency = latency
+        self.jitter = jitter
+        self.fixtures = {}
+        # (server, cmd) -> outputs already replayed, repeated commands (e.g. the
+        # batches of the adaptive ping) get their recorded outputs in order
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def fixture(self, name: str) -> dict:
+        with self.lock:
+            if name not in self.fixtures:
+                self.fixtures[name] = self.load(name)
+            return self.fixtures[name]
+
+    def load(self, name: str) -> dict:
+        for candidate in (name, DEFAULT_FIXTURE):
+            path = os.path.join(self.directory, f"{candidate}.json")
+            if os.path.exists(path):
+                with open(path) as fixture_file:
+                    return json.load(fixture_file)
+        return empty_fixture(name)
+
+    def output(self, cmd: str, server: str, itype: str) -> str:
+        """Next recorded output of a command, an unknown command returns nothing
+        like a failed ssh"""
+        name = fixture_name(server, itype)
+        outputs = self.fixture(name)["commands"].get(cmd, [])
+        if not outputs:
+            return ""
+        with self.lock:
+            position = self.positions.get((server, cmd), 0)
+            self.positions[(server, cmd)] = position + 1
+        return outputs[min(position, len(outputs) - 1)]
+
+    def delay(self) -> float:
+        return self.latency + random.uniform(0, self.jitter)
+
+    def send(self, cmd: str, server="", itype="server") -> str:
+        time.sleep(self.delay())
+        return self.output(cmd, server, itype)
+
+    async def run(self, cmd: str, server="", itype="server") -> str:
+        await asyncio.sleep(self.delay())
+        return self.output(cmd, server, itype)
+
+    async def stream(self, cmd: str, server="", itype="server", stdin=b""):
+        await asyncio.sleep(self.delay())
+        output = self.output(cmd, server, itype)
+        for line in output.split("\n") if output else []:
+            yield line
+
+    def netbox_interfaces(self, server: str, mode: str) -> list:
+        return self.fixture(server)["netbox"].get(mode, [])
+
+    def save_netbox_interfaces(self, server: str, mode: str, rows: list):
+        pass
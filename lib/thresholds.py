@@ -0,0 +1,214 @@
+"""
+Threshold profiles and vectorized scoring of interface_checker metrics
+
+Profiles are read from a JSON file, every profile whose match keys (speed,
+provider, optic) all equal the interface's is applied on top of the default in
+file order:
+
+    {
+        "default": {"light_warning": -9, "light_alarm": -11},
+        "profiles": [
+            {"match": {"speed": "100G"}, "light_alarm": -12},
+            {"match": {"provider": "Zayo", "optic": "QSFP28"}, "loss_warning": 0.05}
+        ],
+        "triage": {"light_severity": "alarm", "always": ["PNI"]}
+    }
+
+The optional triage rules decide which interfaces get the expensive packet loss
+and error counter checks in --triage mode.
+"""
+
+import json
+from dataclasses import dataclass, fields, replace
+from functools import cached_property
+
+import numpy
+
+# 100G optics report one light level per lane
+LANES = 4
+NO_LIGHT = -99
+OK, WARNING, ALARM = 0, 1, 2
+SEVERITIES = {"ok": OK, "warning": WARNING, "alarm": ALARM}
+SEVERITY_COLORS = numpy.array(["white", "yellow", "red"])
+MATCH_KEYS = ("speed", "provider", "optic")
+
+
+@dataclass(frozen=True)
+class Profile:
+    # dBm, lower is worse
+    light_warning: float = -9.0
+    light_alarm: float = -11.0
+    # packet loss percentage, higher is worse, anything above 0.1% is an alarm
+    loss_warning: float = 0.1
+    loss_alarm: float = 0.1
+    # errors counted over the sampling window, higher is worse
+    errors_warning: float = 0.0
+    errors_alarm: float = 1.0
+
+
+PROFILE_KEYS = tuple(x.name for x in fields(Profile))
+
+
+@dataclass(frozen=True)
+class TriageRules:
+    # light severity from which an interface gets the deep checks
+    light_severity: int = WARNING
+    # deep check modules with alarm/warning flags on or crossed DOM thresholds
+    dom_alarms: bool = True
+    # circuit types always deep checked, e.g. ("PNI", "IXP")
+    always: tuple = ()
+    # deep check interfaces with a problem in the history this many days back
+    recent_problem_days: float = 7.0
+
+
+def triage_rules(values: dict) -> TriageRules:
+    """Builds the TriageRules of the triage section of a threshold file"""
+    unknown = set(values) - {x.name for x in fields(TriageRules)}
+    if unknown:
+        raise ValueError(f"unknown triage rule {', '.join(sorted(unknown))}")
+    rules = dict(values)
+    if "light_severity" in rules:
+        rules["light_severity"] = SEVERITIES[str(rules["light_severity"]).lower()]
+    if "always" in rules:
+        rules["always"] = tuple(rules["always"])
+    return TriageRules(**rules)
+
+
+def profile_overrides(values: dict) -> dict:
+    """Threshold overrides of a profile entry, rejects unknown names"""
+    unknown = set(values) - set(PROFILE_KEYS) - {"match"}
+    if unknown:
+        raise ValueError(f"unknown threshold {', '.join(sorted(unknown))}")
+    return {name: float(values[name]) for name in PROFILE_KEYS if name in values}
+
+
+class Profiles:
+    """
+    The default thresholds and the optic, speed and provider specific overrides
+    """
+
+    def __init__(
+        self,
+        default: Profile = None,
+        profiles: list = None,
+        triage: TriageRules = None,
+    ):
+        self.default = default or Profile()
+        # (match, overrides) pairs
+        self.profiles = profiles or []
+        self.triage = triage or TriageRules()
+        self.selected = {}
+
+    @classmethod
+    def load(cls, path: str) -> "Profiles":
+        with open(path) as config_file:
+            config = json.load(config_file)
+        default = replace(Profile(), **profile_overrides(config.get("default", {})))
+        profiles = []
+        for entry in config.get("profiles", []):
+            match = entry.get("match", {})
+            unknown = set(match) - set(MATCH_KEYS)
+            if unknown:
+                raise ValueError(f"unknown match key {', '.join(sorted(unknown))}")
+            profiles.append((match, profile_overrides(entry)))
+        try:
+            triage = triage_rules(config.get("triage", {}))
+        except KeyError as error:
+            raise ValueError(f"unknown triage severity {error}") from None
+        return cls(default, profiles, triage)
+
+    def select(self, speed: str = "", provider: str = "", optic: str = "") -> Profile:
+        """Returns the thresholds of an interface, cached per combination"""
+        key = (speed, provider, optic)
+        if key not in self.selected:
+            values = dict(zip(MATCH_KEYS, key))
+            profile = self.default
+            for match, overrides in self.profiles:
+                if all(values[name] == value for name, value in match.items()):
+                    profile = replace(profile, **overrides)
+            self.selected[key] = profile
+        return self.selected[key]
+
+
+@dataclass
+class Scores:
+    # severities (OK, WARNING, ALARM) per interface, errors are rx, tx, crc
+    errors: numpy.ndarray
+    lanes: numpy.ndarray
+    light: numpy.ndarray
+    loss: numpy.ndarray
+
+    # computed once, the report reads them per interface
+    @cached_property
+    def worst(self) -> numpy.ndarray:
+        return numpy.maximum.reduce(
+            [self.errors.max(axis=1), self.light, self.loss], dtype=int
+        )
+
+    @cached_property
+    def problem(self) -> numpy.ndarray:
+        return self.worst == ALARM
+
+
+def light_matrix(light_levels: list) -> numpy.ndarray:
+    """Pads the per lane light levels of every interface into an (n, LANES) array"""
+    matrix = numpy.full((len(light_levels), LANES), numpy.nan)
+    for row, lanes in enumerate(light_levels):
+        lanes = lanes[:LANES]
+        matrix[row, : len(lanes)] = lanes
+    return matrix
+
+
+def higher_is_worse(values, warning, alarm) -> numpy.ndarray:
+    return numpy.where(
+        values > alarm, ALARM, numpy.where(values > warning, WARNING, OK)
+    )
+
+
+def lower_is_worse(lanes, warning, alarm) -> numpy.ndarray:
+    """Light level severities, a lane without light is an alarm"""
+    return numpy.where(
+        (lanes < alarm) | (lanes == NO_LIGHT),
+        ALARM,
+        numpy.where(lanes < warning, WARNING, OK),
+    )
+
+
+def light_severity(lanes: list, profile: Profile) -> int:
+    """Worst severity of the light levels of one interface"""
+    values = numpy.asarray(lanes, dtype=float)
+    if not values.size:
+        return OK
+    return int(lower_is_worse(values, profile.light_warning, profile.light_alarm).max())
+
+
+def score(
+    errors: list, light_levels: list, packet_loss: list, profiles: list
+) -> Scores:
+    """Scores n interfaces at once
+
+    errors: n rows of (rx, tx, crc) increases
+    light_levels: n lists with the dBm of every lane
+    packet_loss: n loss percentages, NaN when unknown
+    profiles: the Profile of every interface
+    """
+    thresholds = numpy.array(
+        [[getattr(x, name) for name in PROFILE_KEYS] for x in profiles], dtype=float
+    ).reshape(len(profiles), len(PROFILE_KEYS))
+    column = {name: thresholds[:, [i]] for i, name in enumerate(PROFILE_KEYS)}
+    error_matrix = numpy.asarray(errors, dtype=float).reshape(len(profiles), 3)
+    lanes = light_matrix(light_levels)
+    loss = numpy.asarray(packet_loss, dtype=float).reshape(len(profiles), 1)
+    lane_scores = lower_is_worse(lanes, column["light_warning"], column["light_alarm"])
+    return Scores(
+        errors=higher_is_worse(
+            error_matrix, column["errors_warning"], column["errors_alarm"]
+        ),
+        lanes=lane_scores,
+        light=lane_scores.max(axis=1, initial=OK),
+        loss=higher_is_worse(loss, column["loss_warning"], column["loss_alarm"])[:, 0],
+    )
+
+
+def colors(severities: numpy.ndarray) -> list:
+    return SEVERITY_COLORS[severities].tolist()